@@ -0,0 +1,428 @@
+"""Benchmarks of the brightness and luminance hot paths on synthetic image
+sequences.
+
+Sequences are generated locally at the frame sizes of the cameras used in
+the experiments (see `cameras`), and stored as JPEG, TIFF or raw frame
+stack, so no network access is needed. Run the suite with::
+
+    python -m lib.bench --output bench.json
+
+and compare two runs with::
+
+    python -m lib.bench --compare old.json --output new.json
+
+Each result records the throughput (frames or samples per second) and the
+peak resident memory of the benchmarking process and its worker processes.
+Results are written as JSON, together with a description of the machine
+they were obtained on.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as _np
+from PIL import Image as _Image
+from scipy.interpolate import UnivariateSpline as _UnivariateSpline
+from . import load as _load
+from . import luminance as _lum
+from . import parallel as _par
+try:
+    import resource as _resource
+except ImportError:
+    _resource = None
+
+cameras = {
+    'casio-f1': {'shape': (384, 512), 'fps': 300.},
+    'nac': {'shape': (1024, 1280), 'fps': 2000.},
+    'sony-4k': {'shape': (2160, 3840), 'fps': 30.},
+}
+"""Frame shape (rows, columns) and frame rate of the benchmarked cameras."""
+
+formats = ['jpg', 'tif', 'raw']
+
+
+class SyntheticSequence:
+    """Deterministic sequence of grey scale frames that resemble an
+    experiment: a noisy dark background, and a bright blob that grows with
+    the frame number. Frames are generated on access, so long sequences need
+    no memory.
+
+    .. attribute:: frame_shape
+
+        Shape (rows, columns) of the frames.
+
+    .. attribute:: fps
+
+        Frame rate.
+    """
+    def __init__(self, shape, frames, fps=300., seed=0):
+        """See above.
+
+        :param shape: Frame shape.
+        :param frames: Number of frames.
+        :param fps: Frame rate.
+        :param seed: Seed of the background noise.
+        """
+        self.frame_shape = tuple(shape)
+        self.fps = fps
+        self.seed = seed
+        self._len = frames
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if not -self._len <= i < self._len:
+            raise IndexError(i)
+        i %= self._len
+        rng = _np.random.RandomState((self.seed, i))
+        rows, cols = self.frame_shape
+        r = _np.arange(rows)[:, None] - .6 * rows
+        c = _np.arange(cols)[None, :] - .5 * cols
+        rad = .05 * rows + .4 * rows * i / max(self._len - 1, 1)
+        img = 200. * _np.exp(-(r ** 2 + c ** 2) / (2 * rad ** 2))
+        img += rng.normal(20., 3., self.frame_shape)
+        return _np.clip(_np.rint(img), 0, 255).astype(_np.uint8)
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+
+def make_sequence(directory, fmt, shape, frames, fps=300., native=False):
+    """Writes a synthetic sequence to `directory`, unless a complete one is
+    already there, and opens it.
+
+    :param directory: Target folder.
+    :type directory: str
+    :param fmt: One of 'jpg', 'tif' and 'raw'.
+    :type fmt: str
+    :param shape: Frame shape.
+    :type shape: tuple
+    :param frames: Number of frames.
+    :type frames: int
+    :param fps: Frame rate.
+    :type fps: float
+    :param native: Open image files with integer frames (see
+     `load.GreyImageSequence`).
+    :type native: bool
+    :return: The sequence, as `load.imgseq()` would return it.
+    :rtype: load.GreyImageSequence or load.RawSequence
+    """
+    os.makedirs(directory, exist_ok=True)
+    src = SyntheticSequence(shape, frames, fps)
+    if fmt == 'raw':
+        fname = os.path.join(directory, 'frames.npy')
+        if not os.path.exists(fname):
+            _load.save_rawstack(src, fname, fps=fps)
+        return _load.RawSequence(fname)
+    if fmt not in ('jpg', 'tif'):
+        raise ValueError("Unknown format '%s'" % fmt)
+    for i in range(frames):
+        fname = os.path.join(directory, "%06d.%s" % (i, fmt))
+        if not os.path.exists(fname):
+            img = _Image.fromarray(src[i])
+            if fmt == 'jpg':
+                img.save(fname, quality=90)
+            else:
+                img.save(fname)
+    return _load.image_sequence(os.path.join(directory, '*.' + fmt), native)
+
+
+def _peak_rss():
+    """Peak resident memory of this process and of its largest terminated
+    child process, in bytes. `None` where it is not available."""
+    own = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    if _resource is None:
+        return own, None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    if own is None:
+        own = _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss * scale
+    children = _resource.getrusage(_resource.RUSAGE_CHILDREN).ru_maxrss
+    return own, children * scale
+
+
+def _reset_peak_rss():
+    """Resets the peak resident memory of this process, where the system
+    allows that (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _measure(func, count, unit, repeat=1, **info):
+    """Runs `func` `repeat` times and returns a result record with the best
+    rate (`count` items per second)."""
+    _reset_peak_rss()
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    own, children = _peak_rss()
+    info.update({'count': count, 'unit': unit, 'seconds': best,
+                 'rate': count / best if best > 0 else float('inf'),
+                 'peak_rss': own, 'children_peak_rss': children})
+    return info
+
+
+def bench_decode(seq, repeat=1, **info):
+    """Reads all frames of `seq` in this process.
+
+    :return: Result record.
+    :rtype: dict
+    """
+    def run():
+        for frame in seq:
+            pass
+    return _measure(run, len(seq), 'frames', repeat, benchmark='decode',
+                    processes=1, **info)
+
+
+def bench_cumul_bright(seq, select=None, frames=10, repeat=3, **info):
+    """Evaluates `luminance.cumul_bright()` on frames already in memory.
+
+    :param frames: Number of frames of `seq` to use.
+    :type frames: int
+    :return: Result record.
+    :rtype: dict
+    """
+    data = [seq[i] for i in range(min(frames, len(seq)))]
+    select = _lum._prepare_select(select)
+
+    def run():
+        for frame in data:
+            _lum.cumul_bright(frame, select)
+    return _measure(run, len(data), 'frames', repeat,
+                    benchmark='cumul_bright', processes=1, **info)
+
+
+def bench_sequence(seq, processes, select=None, repeat=1,
+                   backend='processes', **info):
+    """Evaluates `luminance.cumul_bright_sequence()` (reading and reducing
+    every frame) with a fresh pool of `processes` workers (or threads, see
+    `parallel.backends`). Starting the workers is not part of the
+    measurement.
+
+    :return: Result record.
+    :rtype: dict
+    """
+    with _par.backends[backend](processes) as ex:
+        _lum.cumul_bright_sequence(seq[:processes], select, executor=ex)
+        rec = _measure(
+            lambda: _lum.cumul_bright_sequence(seq, select, executor=ex),
+            len(seq), 'frames', repeat, benchmark='cumul_bright_sequence',
+            processes=processes, backend=backend, **info)
+    rec['children_peak_rss'] = _peak_rss()[1]
+    return rec
+
+
+def _signal(n, srate=300.):
+    t = _np.arange(n) / srate
+    rng = _np.random.RandomState(0)
+    lum = 1e-2 * (1 + _np.tanh((t - .5 * t[-1]) / (.1 * t[-1] + 1e-9)))
+    return t, lum + 1e-4 * rng.normal(size=n)
+
+
+def bench_filter_lum(n, profile=_lum.prof_casiof1, repeat=3, **info):
+    """Filters a luminance signal of `n` samples with `luminance.filter_lum()`.
+
+    :return: Result record.
+    :rtype: dict
+    """
+    lum = _signal(n, profile.srate)[1]
+    return _measure(lambda: _lum.filter_lum(lum, profile), n, 'samples',
+                    repeat, benchmark='filter_lum', processes=1, **info)
+
+
+def bench_dldot(n, repeat=3, **info):
+    """Evaluates `luminance.dldot()` of a spline through a luminance signal of
+    `n` samples. Fitting the spline is not part of the measurement.
+
+    :return: Result record.
+    :rtype: dict
+    """
+    t, lum = _signal(n)
+    spl = _UnivariateSpline(t, lum, s=n * 1e-8)
+    return _measure(lambda: _lum.dldot(t, spl, threshold=1e-3), n, 'samples',
+                    repeat, benchmark='dldot', processes=1, **info)
+
+
+def _process_counts(nmax=_par._nprocs):
+    ret, p = [], 1
+    while p < nmax:
+        ret.append(p)
+        p *= 2
+    return ret + [nmax]
+
+
+def run_benchmarks(cams=None, fmts=None, frames=100, processes=None,
+                   samples=2 ** 20, workdir=None, repeat=1, native=False,
+                   backend='processes', log=print):
+    """Runs the benchmark suite.
+
+    :param cams: Names of cameras (keys of `cameras`). Default is all.
+    :type cams: list
+    :param fmts: Image formats (see `formats`). Default is all.
+    :type fmts: list
+    :param frames: Number of frames per sequence.
+    :type frames: int
+    :param processes: Numbers of worker processes to measure the scaling
+     with. Default is powers of two up to the number of CPUs.
+    :type processes: list
+    :param samples: Length of the signals for the signal processing
+     benchmarks.
+    :type samples: int
+    :param workdir: Folder to write the synthetic sequences to. They are
+     kept there and reused by later runs. Default is a temporary folder that
+     is removed afterwards.
+    :type workdir: str
+    :param repeat: Number of repetitions; the fastest one is reported.
+    :type repeat: int
+    :param native: Read image files with integer frames instead of float64
+     frames.
+    :type native: bool
+    :param backend: Execution backend of `luminance.cumul_bright_sequence()`.
+    :type backend: str
+    :param log: Function to report progress with.
+    :type log: callable
+    :return: Report with keys 'machine' and 'results' (a list of result
+     records).
+    :rtype: dict
+    """
+    cams = list(cameras) if cams is None else cams
+    fmts = formats if fmts is None else fmts
+    processes = _process_counts() if processes is None else processes
+    tmp = workdir is None
+    if tmp:
+        workdir = tempfile.mkdtemp(prefix='lumbench')
+    results = []
+
+    def add(rec):
+        results.append(rec)
+        log("%-22s %-9s %-4s %3d proc: %10.1f %s/s"
+            % (rec['benchmark'], rec.get('camera', '-'),
+               rec.get('format', '-'), rec['processes'], rec['rate'],
+               rec['unit']))
+    try:
+        add(bench_filter_lum(samples, repeat=max(repeat, 3)))
+        add(bench_dldot(samples, repeat=max(repeat, 3)))
+        for cam in cams:
+            spec = cameras[cam]
+            for fmt in fmts:
+                seq = make_sequence(os.path.join(workdir, cam, fmt), fmt,
+                                    spec['shape'], frames, spec['fps'],
+                                    native)
+                info = {'camera': cam, 'format': fmt, 'native': native,
+                        'shape': list(spec['shape'])}
+                add(bench_decode(seq, repeat, **info))
+                if fmt == fmts[0]:
+                    add(bench_cumul_bright(seq, **info))
+                for p in processes:
+                    add(bench_sequence(seq, p, repeat=repeat,
+                                       backend=backend, **info))
+    finally:
+        if tmp:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {'machine': {
+        'platform': platform.platform(), 'python': platform.python_version(),
+        'numpy': _np.__version__, 'cpus': _par._nprocs,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }, 'results': results}
+
+
+def _key(rec):
+    return (rec['benchmark'], rec.get('camera'), rec.get('format'),
+            rec.get('native', False), rec.get('backend'), rec['processes'])
+
+
+def compare(old, new, tolerance=.1):
+    """Finds throughput regressions between two benchmark reports.
+
+    :param old: Reference report, as returned by `run_benchmarks()`.
+    :type old: dict
+    :param new: Report to check.
+    :type new: dict
+    :param tolerance: Relative loss of throughput that is not reported.
+    :type tolerance: float
+    :return: List of (benchmark, camera, format, native, backend, processes,
+     old rate, new rate) for every benchmark that got slower by more than
+     `tolerance`.
+    :rtype: list
+    """
+    ref = {_key(r): r['rate'] for r in old['results']}
+    ret = []
+    for r in new['results']:
+        k = _key(r)
+        if k in ref and r['rate'] < (1 - tolerance) * ref[k]:
+            ret.append(k + (ref[k], r['rate']))
+    return ret
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='python -m lib.bench',
+        description="Benchmark brightness and luminance computations on "
+                    "synthetic image sequences.")
+    parser.add_argument('--cameras', nargs='+', choices=list(cameras),
+                        help="camera frame sizes to benchmark")
+    parser.add_argument('--formats', nargs='+', choices=formats,
+                        help="image formats to benchmark")
+    parser.add_argument('--frames', type=int, default=100,
+                        help="frames per sequence")
+    parser.add_argument('--processes', type=int, nargs='+',
+                        help="worker process counts to measure")
+    parser.add_argument('--samples', type=int, default=2 ** 20,
+                        help="signal length for filter_lum and dldot")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="repetitions per benchmark (fastest counts)")
+    parser.add_argument('--native', action='store_true',
+                        help="read image files with integer frames")
+    parser.add_argument('--backend', choices=sorted(_par.backends),
+                        default='processes',
+                        help="execution backend for cumul_bright_sequence")
+    parser.add_argument('--workdir',
+                        help="keep the synthetic sequences in this folder")
+    parser.add_argument('--output', default='bench.json',
+                        help="result file (JSON)")
+    parser.add_argument('--compare', metavar='REFERENCE',
+                        help="report regressions against this result file")
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help="relative slow down reported as regression")
+    args = parser.parse_args(argv)
+    ref = None
+    if args.compare:
+        with open(args.compare) as f:
+            ref = json.load(f)
+    report = run_benchmarks(args.cameras, args.formats, args.frames,
+                            args.processes, args.samples, args.workdir,
+                            args.repeat, args.native, args.backend)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if ref is not None:
+        regressions = compare(ref, report, args.tolerance)
+        for bench, cam, fmt, native, backend, p, old, new in regressions:
+            print("Regression: %s %s %s%s %s %d: %.1f/s -> %.1f/s"
+                  % (bench, cam, fmt, " (native)" if native else "",
+                     backend or '', p, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
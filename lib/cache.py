@@ -0,0 +1,378 @@
+"""On-disk cache for brightness arrays B(t) computed by the `luminance`
+module, and checkpoints of partial results."""
+import os
+import json
+import time
+import hashlib
+import numpy as _np
+from . import load as _load
+
+
+def _select_token(select):
+    """Converts a selection (or list/dict of selections) to something that
+    can be serialized in a reproducible way."""
+    if select is None:
+        return None
+    if hasattr(select, 'cache_key'):
+        return select.cache_key
+    if isinstance(select, dict):
+        return {'dict': [[str(k), _select_token(v)]
+                         for k, v in select.items()]}
+    if isinstance(select, _np.ndarray):
+        h = hashlib.sha1(_np.ascontiguousarray(select).tobytes())
+        h.update(("%s%s" % (select.shape, select.dtype)).encode())
+        return 'array:' + h.hexdigest()
+    if isinstance(select, (list, tuple)):
+        return [_select_token(s) for s in select]
+    if isinstance(select, (int, _np.integer)):
+        return int(select)
+    if isinstance(select, (float, _np.floating)):
+        return float(select)
+    return repr(select)
+
+
+def sequence_key(seq):
+    """Digest identifying the frames of an image sequence. It is built from
+    path, size and modification time of every file the frames are read from,
+    the frame indices, and the reduction factor of preview sequences.
+
+    :param seq: Image sequence, or a slice of one.
+    :type seq: Slicerator
+    :return: Hex digest, or `None` if `seq` is not backed by files.
+    :rtype: str or None
+    """
+    files = _load.sequence_sources(seq)
+    if files is None:
+        return None
+    reader, idx = _load.sequence_indices(seq)
+    h = hashlib.sha1(type(reader).__name__.encode())
+    if getattr(reader, 'scale', 1) != 1:
+        h.update(("scale %d\n" % reader.scale).encode())
+    for f in files:
+        st = os.stat(f)
+        h.update(("%s|%d|%d\n" % (f, st.st_size, st.st_mtime_ns)).encode())
+    h.update(idx.tobytes())
+    return h.hexdigest()
+
+
+def _frame_dtype(seq):
+    try:
+        return str(_np.dtype(seq.pixel_type))
+    except AttributeError:
+        return str(_np.asarray(seq[0]).dtype)
+
+
+def _entry_key(seq, select=None, dtype=None):
+    skey = sequence_key(seq)
+    if skey is None:
+        return None
+    dtype = _frame_dtype(seq) if dtype is None else str(_np.dtype(dtype))
+    tok = json.dumps([skey, _select_token(select), dtype], sort_keys=True)
+    return hashlib.sha1(tok.encode()).hexdigest(), skey
+
+
+class BrightnessCache:
+    """Persistent store of brightness arrays B(t). Entries are keyed by the
+    image files a sequence is read from (path, size, modification time), the
+    frame selection and the frame dtype, so modified or replaced images never
+    produce stale hits. Least recently used entries are evicted once the cache
+    grows beyond `max_size`.
+
+    .. attribute:: directory
+
+        Folder holding the cache entries.
+
+    .. attribute:: max_size
+
+        Size limit of the cache in bytes. `None` means no limit.
+    """
+    def __init__(self, directory='data' + os.sep + 'cache', max_size=2 ** 30):
+        """See above.
+
+        :param directory:
+        :param max_size:
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.npy', base + '.json'
+
+    def _entries(self):
+        for f in os.listdir(self.directory):
+            if f.endswith('.json'):
+                yield f[:-5]
+
+    def key(self, seq, select=None, dtype=None):
+        """Cache key for `seq` and `select`.
+
+        :param seq: Image sequence.
+        :type seq: Slicerator
+        :param select: Frame selection(s) as passed to
+         `luminance.cumul_bright_sequence()`.
+        :type select: tuple, list or dict
+        :param dtype: Frame dtype. Taken from `seq` if not given.
+        :type dtype: numpy.dtype
+        :return: (key, sequence key), or `None` if `seq` cannot be cached.
+        :rtype: tuple or None
+        """
+        return _entry_key(seq, select, dtype)
+
+    def get(self, seq, select=None, dtype=None):
+        """Looks up the brightness array of `seq`.
+
+        :return: Cached B(t), or `None` if there is no entry.
+        :rtype: ndarray or None
+        """
+        k = self.key(seq, select, dtype)
+        if k is None:
+            return None
+        data, meta = self._paths(k[0])
+        if not os.path.exists(meta):
+            return None
+        try:
+            ret = _np.load(data)
+        except (IOError, ValueError):
+            self._remove(k[0])
+            return None
+        os.utime(data)
+        return ret
+
+    def put(self, seq, values, select=None, dtype=None):
+        """Stores brightness array `values` computed from `seq` and `select`,
+        then evicts old entries if the size limit is exceeded. Sequences that
+        are not backed by files are not stored.
+
+        :param seq: Image sequence.
+        :type seq: Slicerator
+        :param values: Brightness array B(t).
+        :type values: ndarray
+        :param select: Frame selection(s).
+        :type select: tuple, list or dict
+        :param dtype: Frame dtype. Taken from `seq` if not given.
+        :type dtype: numpy.dtype
+        :return: Key of the new entry, or `None`.
+        :rtype: str or None
+        """
+        k = self.key(seq, select, dtype)
+        if k is None:
+            return None
+        data, meta = self._paths(k[0])
+        tmp = data + '.tmp'
+        with open(tmp, 'wb') as f:
+            _np.save(f, values)
+        os.replace(tmp, data)
+        with open(meta + '.tmp', 'w') as f:
+            json.dump({'sequence': k[1], 'select': _select_token(select),
+                       'frames': len(values), 'created': time.time()}, f)
+        os.replace(meta + '.tmp', meta)
+        self.evict()
+        return k[0]
+
+    def _remove(self, key):
+        for p in self._paths(key):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def invalidate(self, seq=None, select=None):
+        """Removes entries. Without arguments everything is removed.
+
+        :param seq: Only remove entries computed from this sequence.
+        :type seq: Slicerator
+        :param select: Only remove entries with this selection. Together with
+         `seq` this removes a single entry.
+        :type select: tuple, list or dict
+        :return: Number of removed entries.
+        :rtype: int
+        """
+        skey = None if seq is None else sequence_key(seq)
+        tok = None if select is None else _select_token(select)
+        n = 0
+        for key in list(self._entries()):
+            if skey is not None or tok is not None:
+                try:
+                    with open(self._paths(key)[1]) as f:
+                        meta = json.load(f)
+                except (IOError, ValueError):
+                    meta = {}
+                if skey is not None and meta.get('sequence') != skey:
+                    continue
+                if tok is not None and meta.get('select') != tok:
+                    continue
+            self._remove(key)
+            n += 1
+        return n
+
+    def clear(self):
+        """Removes all entries."""
+        return self.invalidate()
+
+    def size(self):
+        """Total size of the stored entries in bytes."""
+        ret = 0
+        for key in self._entries():
+            for p in self._paths(key):
+                if os.path.exists(p):
+                    ret += os.path.getsize(p)
+        return ret
+
+    def evict(self, max_size=None):
+        """Removes least recently used entries until the cache is not larger
+        than `max_size`.
+
+        :param max_size: Size limit in bytes. Defaults to `self.max_size`.
+        :type max_size: int
+        :return: Number of removed entries.
+        :rtype: int
+        """
+        limit = self.max_size if max_size is None else max_size
+        if limit is None:
+            return 0
+        items = []
+        for key in self._entries():
+            data, meta = self._paths(key)
+            try:
+                st = os.stat(data)
+                items.append((st.st_mtime, st.st_size + os.path.getsize(meta),
+                              key))
+            except OSError:
+                self._remove(key)
+        total, n = sum(i[1] for i in items), 0
+        for _, sz, key in sorted(items):
+            if total <= limit:
+                break
+            self._remove(key)
+            total -= sz
+            n += 1
+        return n
+
+
+class Checkpoint:
+    """Partial result of a computation over the frames of a sequence, kept in
+    two memory mapped `.npy` files: the values, and a mask of the frames that
+    are done. Finished chunks are written as they arrive, so an interrupted
+    computation (killed worker, out of memory, restarted notebook, preempted
+    job) can be resumed and only the missing frames are computed again.
+
+    Values are flushed before their frames are marked as done, so a frame is
+    never marked done with incomplete data.
+
+    .. attribute:: fname
+
+        Base file name; the files are `fname + '.npy'` and
+        `fname + '.done.npy'`.
+
+    .. attribute:: values
+
+        Memory mapped array of shape (frames,) + shape.
+
+    .. attribute:: done
+
+        Memory mapped boolean array, True for finished frames.
+    """
+    def __init__(self, fname, frames, shape=(), dtype=_np.float64):
+        """See above. Existing files are reused if they match `frames`,
+        `shape` and `dtype`, and replaced otherwise.
+
+        :param fname:
+        :param frames: Number of frames.
+        :param shape: Shape of the value of a single frame.
+        :param dtype: Data type of the values.
+        """
+        self.fname = fname
+        oshape = (frames,) + tuple(shape)
+        dtype = _np.dtype(dtype)
+        try:
+            values = _np.load(fname + '.npy', mmap_mode='r+')
+            done = _np.load(fname + '.done.npy', mmap_mode='r+')
+            if values.shape != oshape or values.dtype != dtype \
+                    or done.shape != (frames,):
+                raise ValueError
+        except (IOError, ValueError):
+            values = _np.lib.format.open_memmap(
+                fname + '.npy', mode='w+', dtype=dtype, shape=oshape)
+            done = _np.lib.format.open_memmap(
+                fname + '.done.npy', mode='w+', dtype=_np.bool_,
+                shape=(frames,))
+        self.values, self.done = values, done
+
+    def __len__(self):
+        return len(self.done)
+
+    @property
+    def complete(self):
+        """True if all frames are done."""
+        return bool(self.done.all())
+
+    def missing(self):
+        """Indices of the frames that are not done yet.
+
+        :rtype: ndarray
+        """
+        return _np.flatnonzero(~self.done)
+
+    def missing_ranges(self):
+        """Consecutive ranges of frames that are not done yet.
+
+        :return: List of (start, end) tuples.
+        :rtype: list
+        """
+        d = _np.diff(_np.concatenate(([0], ~self.done, [0])).astype(_np.int8))
+        return list(zip(_np.flatnonzero(d == 1).tolist(),
+                        _np.flatnonzero(d == -1).tolist()))
+
+    def save(self, frames, values):
+        """Stores `values` of `frames` and marks them as done.
+
+        :param frames: Frame indices, or a slice.
+        :type frames: ndarray or slice
+        :param values: Values of these frames.
+        :type values: ndarray
+        """
+        self.values[frames] = values
+        self.values.flush()
+        self.done[frames] = True
+        self.done.flush()
+
+    def result(self):
+        """Copy of all values, which are only valid where `done` is set.
+
+        :rtype: ndarray
+        """
+        return _np.array(self.values)
+
+    def remove(self):
+        """Deletes the checkpoint files."""
+        self.values = self.done = None
+        for ext in ('.npy', '.done.npy'):
+            if os.path.exists(self.fname + ext):
+                os.remove(self.fname + ext)
+
+
+def checkpoint(directory, seq, select=None, shape=(), dtype=_np.float64):
+    """Opens the checkpoint of a computation over `seq` with selection
+    `select`, or starts a new one. Checkpoints are keyed like cache entries
+    (see `BrightnessCache`), so frames that changed on disk do not resume
+    from stale values.
+
+    :param directory: Folder for checkpoint files.
+    :type directory: str
+    :param seq: Image sequence.
+    :type seq: Slicerator
+    :param select: Frame selection(s), part of the key.
+    :type select: tuple, list or dict
+    :param shape: Shape of the value of a single frame.
+    :type shape: tuple
+    :param dtype: Data type of the values.
+    :type dtype: numpy.dtype
+    :return: The checkpoint, or `None` if `seq` is not backed by files.
+    :rtype: Checkpoint or None
+    """
+    k = _entry_key(seq, select)
+    if k is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return Checkpoint(os.path.join(directory, k[0] + '.part'), len(seq),
+                      shape, dtype)
@@ -0,0 +1,258 @@
+"""Batch processing of many runs and cameras without the notebook.
+
+A campaign is described by a JSON configuration file::
+
+    {
+        "output": "results",
+        "processes": 8,
+        "cache": "data/cache",
+        "checkpoint": "data/checkpoints",
+        "defaults": {
+            "rois": {"full": null},
+            "calibration": {"res": 0.003953, "sres": 3.1e-05,
+                            "bmelt": 175.0, "sbmelt": 5.0,
+                            "noise_frames": 94}
+        },
+        "jobs": [
+            {"run": "pr06", "cam": "casio-f1",
+             "rois": {"full": null, "crucible": [[0, 250], [140, 440]]}}
+        ]
+    }
+
+`jobs` can also be "all" for every run and camera in `load.tested_videos`.
+Regions of interest are rectangles [[start0, end0], [start1, end1]], `null`
+for the whole frame, or {"polygon": [[row, col], ...]}. Calibration values
+are the spatial resolution `res` (meters per pixel), the melt brightness per
+pixel `bmelt`, their standard deviations `sres` and `sbmelt` (default 0), and
+the number of pre-event frames `noise_frames` that define the noise level.
+Job entries override the defaults.
+
+Run it with::
+
+    python -m lib.campaign campaign.json
+
+Each job reads its frames once (all regions in the same pass, spread over
+all worker processes) and writes `<output>/<run>_<cam>.npz`. Jobs whose
+result exists and was computed with the same settings are skipped. A
+manifest with status and timings of every job is kept in
+`<output>/manifest.json`.
+
+With a "checkpoint" folder, brightness computed so far is saved while a job
+runs. A job that was interrupted (e.g. a preempted batch job) then continues
+with the frames that are still missing when the campaign is started again.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import numpy as _np
+from . import load as _load
+from . import luminance as _lum
+from . import cache as _cache
+
+
+def load_config(fname):
+    """Reads a campaign configuration file.
+
+    :param fname: JSON file name.
+    :type fname: str
+    :rtype: dict
+    """
+    with open(fname) as f:
+        return json.load(f)
+
+
+def expand_jobs(config):
+    """List of fully specified jobs of a campaign: each entry has 'run',
+    'cam', 'rois' and 'calibration', with the campaign defaults filled in.
+
+    :param config: Campaign configuration.
+    :type config: dict
+    :rtype: list
+    """
+    defaults = config.get('defaults', {})
+    jobs = config.get('jobs', 'all')
+    if jobs == 'all':
+        jobs = [{'run': run, 'cam': cam}
+                for run in _load.runs for cam in _load.tested_videos[run]]
+    ret = []
+    for job in jobs:
+        calib = dict(defaults.get('calibration', {}))
+        calib.update(job.get('calibration', {}))
+        ret.append({
+            'run': job['run'], 'cam': job['cam'],
+            'rois': job.get('rois', defaults.get('rois', {'full': None})),
+            'calibration': calib
+        })
+    return ret
+
+
+def job_name(job):
+    """Name of a job, also used for its output file."""
+    return "%s_%s" % (job['run'], job['cam'])
+
+
+def _job_hash(job, video):
+    tok = json.dumps([job, bool(video)], sort_keys=True)
+    return hashlib.sha1(tok.encode()).hexdigest()
+
+
+def _region(roi, shape):
+    """Converts a region of interest from the configuration file to a
+    selection for `luminance.cumul_bright_sequence()`, and its area in
+    pixels."""
+    if roi is None:
+        return None, float(shape[0] * shape[1])
+    if isinstance(roi, dict):
+        mask = _lum.RegionMask.from_polygon(roi['polygon'], shape)
+        return mask, mask.area
+    ((start0, end0), (start1, end1)) = roi
+    sel = ((int(start0), int(end0)), (int(start1), int(end1)))
+    h = len(range(*slice(start0, end0).indices(shape[0])))
+    w = len(range(*slice(start1, end1).indices(shape[1])))
+    return sel, float(h * w)
+
+
+def job_pipeline(job, shape, processes=_lum._nprocs, cache=None,
+                 checkpoint=None):
+    """Sets up the computation of a job for frames of size `shape`.
+
+    :param job: Job as returned by `expand_jobs()`.
+    :type job: dict
+    :param shape: Frame shape (rows, columns).
+    :type shape: tuple
+    :return: (pipeline, extra), where `extra` is a dict of the region names,
+     fields of view and reference brightnesses that go with the results.
+    :rtype: tuple
+    """
+    names = list(job['rois'].keys())
+    sels, areas = zip(*(_region(job['rois'][k], shape) for k in names))
+    areas = _np.array(areas)
+    calib = job['calibration']
+    fov = calib['res'] ** 2 * areas
+    ref = calib['bmelt'] * areas
+    pipe = _lum.LuminancePipeline(
+        int(calib['noise_frames']), fov, ref, list(sels),
+        sfov=2 * fov * calib.get('sres', 0.) / calib['res'],
+        sref=calib.get('sbmelt', 0.) * areas, processes=processes,
+        cache=cache, checkpoint=checkpoint)
+    return pipe, {'regions': _np.array(names), 'fov': fov, 'ref': ref}
+
+
+def process_job(job, processes=_lum._nprocs, cache=None, video=False,
+                checkpoint=None):
+    """Computes brightness and luminance of all regions of one job.
+
+    :param job: Job as returned by `expand_jobs()`.
+    :type job: dict
+    :param processes: Number of worker processes.
+    :type processes: int
+    :param cache: Optional brightness cache.
+    :type cache: cache.BrightnessCache
+    :param video: Decode video data sets directly (see `load.imgseq()`).
+    :type video: bool
+    :param checkpoint: Folder for partial results of interrupted jobs.
+    :type checkpoint: str
+    :return: (results, timings), where `results` is a dict of arrays (as
+     stored in the job's `.npz` file) and `timings` a dict of durations in
+     seconds.
+    :rtype: tuple
+    """
+    t0 = time.time()
+    seq = _load.imgseq(job['run'], job['cam'], video=video)
+    shape = tuple(_np.shape(seq[0])[:2])
+    t1 = time.time()
+    pipe, extra = job_pipeline(job, shape, processes, cache, checkpoint)
+    ret = pipe.run(seq)
+    ret.update(extra)
+    t2 = time.time()
+    return ret, {'load': t1 - t0, 'process': t2 - t1, 'total': t2 - t0}
+
+
+def _write_manifest(fname, manifest):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def run_campaign(config, force=False, log=print):
+    """Processes all jobs of a campaign, skipping jobs whose results are up
+    to date. Failing jobs are recorded in the manifest and do not stop the
+    campaign.
+
+    :param config: Campaign configuration (see module documentation).
+    :type config: dict
+    :param force: Recompute all jobs.
+    :type force: bool
+    :param log: Function to report progress with.
+    :type log: callable
+    :return: The manifest.
+    :rtype: dict
+    """
+    out = config.get('output', 'results')
+    os.makedirs(out, exist_ok=True)
+    mname = os.path.join(out, 'manifest.json')
+    try:
+        with open(mname) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {'jobs': {}}
+    processes = config.get('processes', _lum._nprocs)
+    video = config.get('video', False)
+    cache = _cache.BrightnessCache(config['cache']) \
+        if config.get('cache') else None
+    for job in expand_jobs(config):
+        name = job_name(job)
+        h = _job_hash(job, video)
+        fname = os.path.join(out, name + '.npz')
+        entry = manifest['jobs'].get(name, {})
+        if not force and entry.get('status') == 'done' \
+                and entry.get('config') == h and os.path.exists(fname):
+            log("%s: up to date" % name)
+            continue
+        log("%s: processing" % name)
+        try:
+            res, timings = process_job(job, processes, cache, video,
+                                       config.get('checkpoint'))
+            _np.savez(fname, **res)
+            entry = {'status': 'done', 'config': h, 'output': fname,
+                     'frames': len(res['B']), 'timings': timings,
+                     'frames_per_s': len(res['B']) / timings['total']}
+            log("%s: %d frames in %.1f s" % (name, entry['frames'],
+                                            timings['total']))
+        except Exception:
+            entry = {'status': 'failed', 'config': h,
+                     'error': traceback.format_exc()}
+            log("%s: failed\n%s" % (name, entry['error']))
+        entry['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        manifest['jobs'][name] = entry
+        _write_manifest(mname, manifest)
+    return manifest
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='python -m lib.campaign',
+        description="Compute brightness and luminance for a campaign of "
+                    "runs and cameras.")
+    parser.add_argument('config', help="campaign configuration (JSON)")
+    parser.add_argument('--force', action='store_true',
+                        help="recompute jobs with up to date results")
+    parser.add_argument('--processes', type=int,
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    if args.processes is not None:
+        config['processes'] = args.processes
+    manifest = run_campaign(config, force=args.force)
+    failed = [k for k, v in manifest['jobs'].items()
+              if v.get('status') == 'failed']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,32 @@
 """Data loading and download helper for the `luminance` module."""
+import io
 import os
+import re
 import sys
-from urllib.request import urlretrieve
+import glob
+import json
+import hashlib
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
 import pims
 import numpy
+from PIL import Image
 import zipfile
 import warnings
+from slicerator import Slicerator
 
 
 show_warnings = True
+"""Set to False to ignore `UserWarning` s of the image decoders (e.g. about
+corrupt meta data) once an image sequence is opened."""
+ffmpeg = 'ffmpeg'
+ffprobe = 'ffprobe'
+checksums = {}
+"""Known SHA-256 hex digests of downloads, by URL. Downloads with an entry
+here are verified against it."""
 
 
 def show(run=True, cam=True, url=False):
@@ -50,43 +68,321 @@ def _videoname(run, cam):
     return run + "_" + cam + ".mp4"
 
 
-def download_dataset(run, cam, targetbase='data' + os.sep):
+def _content_total(resp, pos):
+    """Total size of the resource from the headers of a (possibly partial)
+    response, or `None` if unknown."""
+    rng = resp.headers.get('Content-Range')
+    if rng is not None:
+        total = rng[rng.rfind('/') + 1:].strip()
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get('Content-Length')
+    return int(length) + pos if length is not None else None
+
+
+def _sha256(fname, blocksize=2 ** 20):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for buf in iter(lambda: f.read(blocksize), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def fetch(url, trg, size=None, sha256=None, retries=5, timeout=60,
+          blocksize=2 ** 20):
+    """Downloads `url` to `trg`. Data is written to `trg + '.part'` first,
+    and an interrupted download resumes from there with an HTTP range
+    request (also in a later call). `trg` only appears once the download is
+    complete and verified.
+
+    :param url: Source URL.
+    :type url: str
+    :param trg: Target file name.
+    :type trg: str
+    :param size: Expected size in bytes. Default is the size reported by the
+     server.
+    :type size: int
+    :param sha256: Expected SHA-256 hex digest. Default is the entry of `url`
+     in `checksums`, if any.
+    :type sha256: str
+    :param retries: Number of times to reconnect after a dropped connection.
+    :type retries: int
+    :param timeout: Socket timeout in seconds.
+    :type timeout: float
+    :param blocksize: Size of the blocks written to disk.
+    :type blocksize: int
+    :return: `trg`.
+    :rtype: str
+    :raises IOError: if the download cannot be completed, or the file does
+     not match the expected size or checksum.
+    """
+    if sha256 is None:
+        sha256 = checksums.get(url)
+    part = trg + '.part'
+    total = size
+    for attempt in range(retries + 1):
+        pos = os.path.getsize(part) if os.path.exists(part) else 0
+        if total is not None and pos == total:
+            break
+        headers = {'Range': 'bytes=%d-' % pos} if pos else {}
+        try:
+            with urlopen(Request(url, headers=headers),
+                         timeout=timeout) as resp:
+                if pos and resp.status != 206:
+                    pos = 0
+                if total is None:
+                    total = _content_total(resp, pos)
+                with open(part, 'r+b' if pos else 'wb') as f:
+                    f.seek(pos)
+                    f.truncate()
+                    for buf in iter(lambda: resp.read(blocksize), b''):
+                        f.write(buf)
+        except HTTPError as e:
+            if e.code != 416 or not pos:
+                raise
+            # Range not satisfiable: the part file is complete already, or
+            # longer than the resource and has to be fetched again.
+            total = _content_total(e, 0) if total is None else total
+            if total is None or pos > total:
+                os.remove(part)
+                total = size
+            continue
+        except (URLError, OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            continue
+        if total is None or os.path.getsize(part) >= total:
+            break
+    got = os.path.getsize(part) if os.path.exists(part) else 0
+    if total is not None and got != total:
+        if got > total:
+            os.remove(part)
+        raise IOError("Download of %s has %d bytes instead of %d"
+                      % (url, got, total))
+    if sha256 is not None and _sha256(part) != sha256.lower():
+        os.remove(part)
+        raise IOError("Checksum of %s does not match, removed the "
+                      "download" % url)
+    os.replace(part, trg)
+    return trg
+
+
+def _dataset_targets(run, cam, targetbase='data' + os.sep):
+    """(url, target file) pairs of all files of a data set."""
+    urls = tested_videos[run][cam]
+    if isinstance(urls, str):
+        urls = [urls]
+    sk = "-" if len(urls) > 1 else "."
+    return [(rl, targetbase + "%s_%s" % (run, cam) + rl[rl.rfind(sk):])
+            for rl in urls]
+
+
+def _mark_extracted(run, cam, base, targetbase='data' + os.sep):
+    """Writes the extraction markers of a data set whose image folder `base`
+    was extracted before extractions were tracked: no part has a marker, no
+    download is unfinished, and the folder holds images.
+
+    :return: Whether markers were written.
+    :rtype: bool
+    """
+    try:
+        targets = [trg for _, trg in _dataset_targets(run, cam, targetbase)]
+    except KeyError:
+        return False
+    if any(os.path.exists(trg + ext) for trg in targets
+           for ext in ('.extracted', '.extracting', '.part')) \
+            or not (os.path.isdir(base) and os.listdir(base)):
+        return False
+    for trg in targets:
+        if os.path.exists(trg):
+            open(trg + '.extracted', 'w').close()
+    return True
+
+
+def _pending_parts(run, cam, targetbase='data' + os.sep):
+    """Whether downloading or extracting archive parts of a data set was
+    interrupted (see also `_mark_extracted()`)."""
+    try:
+        targets = [trg for _, trg in _dataset_targets(run, cam, targetbase)]
+    except KeyError:
+        return False
+    if any(os.path.exists(trg + '.extracted')
+           or os.path.exists(trg + '.extracting') for trg in targets):
+        return not all(os.path.exists(trg + '.extracted') for trg in targets)
+    return any(os.path.exists(trg + '.part') or os.path.exists(trg)
+               for trg in targets)
+
+
+def _missing_parts(run, cam, targetbase='data' + os.sep):
+    """Whether files of a data set have not been downloaded completely."""
+    try:
+        targets = _dataset_targets(run, cam, targetbase)
+    except KeyError:
+        return False
+    return not all(os.path.exists(trg) for _, trg in targets)
+
+
+def download_dataset(run, cam, targetbase='data' + os.sep, workers=4,
+                     extract=None):
+    """Downloads all files of a data set from VHub, several at a time.
+    Files that are already complete are skipped, interrupted downloads are
+    resumed (see `fetch()`).
+
+    :param run: Experiment id.
+    :type run: str
+    :param cam: Camera id.
+    :type cam: str
+    :param targetbase: Download folder.
+    :type targetbase: str
+    :param workers: Number of concurrent downloads.
+    :type workers: int
+    :param extract: Image folder to extract zip archives to (see
+     `unarchive_imgseq()`). Each archive is extracted as soon as it has
+     arrived, while the others are still downloading.
+    :type extract: str
+    :return: List of the downloaded files.
+    :rtype: list
+    """
     if not os.path.exists(targetbase):
         os.makedirs(targetbase, exist_ok=True)
     try:
-        urls = tested_videos[run][cam]
-        if isinstance(urls, str):
-            urls = [urls]
-        ret = []
-        sk = "-" if len(urls) > 1 else "."
-        for rl in urls:
-            trg = targetbase + "%s_%s" % (run, cam) + rl[rl.rfind(sk):]
-            if not os.path.exists(trg):
-                print('Downloading video from %s to %s' % (rl, trg))
-                urlretrieve(rl, trg)
-            ret.append(trg)
-        return ret
+        targets = _dataset_targets(run, cam, targetbase)
     except KeyError:
         print("Got wrong identifier: run: %s, cam: %s" % (run, cam),
               file=sys.stderr)
         raise
 
+    def get(rl, trg):
+        if not os.path.exists(trg):
+            print('Downloading from %s to %s' % (rl, trg))
+            fetch(rl, trg)
+        return trg
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        futures = [ex.submit(get, rl, trg) for rl, trg in targets]
+        for fut in as_completed(futures):
+            trg = fut.result()
+            if extract is not None and trg.endswith('.zip') \
+                    and not os.path.exists(trg + '.extracted'):
+                unarchive_imgseq([trg], extract)
+    return [trg for _, trg in targets]
+
+
+def _segment_marker(base, start, end):
+    return os.path.join(base, '.frames-%08d-%08d.done' % (start, end))
+
+
+def _conversion_plan(base):
+    return os.path.join(base, '.segments.json')
+
+
+def _conversion_pending(base):
+    """Whether a segmented video conversion into `base` is incomplete."""
+    plan = _conversion_plan(base)
+    if not os.path.exists(plan):
+        return False
+    with open(plan) as f:
+        segments = json.load(f)['segments']
+    return not all(os.path.exists(_segment_marker(base, *seg))
+                   for seg in segments)
 
-def convert_video_to_imgseq(vname, base):
+
+def _convert_segment(fname, base, start, end, fps, last, threads):
+    """Decodes frames `start` to `end` of video `fname` to JPEG files in
+    `base`, numbered from `start + 1` like a conversion of the whole video.
+    The last segment is decoded to the end of the video."""
+    cmd = [ffmpeg, '-v', 'error', '-nostdin', '-y']
+    if start > 0:
+        cmd += ['-ss', '%.6f' % ((start - .5) / fps)]
+    cmd += ['-i', fname, '-vsync', '0', '-threads', str(threads)]
+    if not last:
+        cmd += ['-frames:v', str(end - start)]
+    cmd += ['-q:v', '1', '-start_number', str(start + 1),
+            os.path.join(base, 'frame%08d.jpg')]
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise IOError("ffmpeg failed on frames %d to %d of '%s' (exit code "
+                      "%d):\n%s" % (start, end, fname, proc.returncode,
+                                    proc.stderr.decode(errors='replace')))
+    check = [start + 1] if last else [start + 1, end]
+    for i in check:
+        if not os.path.exists(os.path.join(base, 'frame%08d.jpg' % i)):
+            raise IOError("ffmpeg did not write frame %d of '%s'"
+                          % (i, fname))
+    open(_segment_marker(base, start, end), 'w').close()
+
+
+def convert_video_to_imgseq(vname, base, workers=None, segments=None):
+    """Converts a video in the `data` folder to JPEG images
+    `base/frame00000001.jpg`, ... The video is split into segments of
+    consecutive frames that are decoded by parallel `ffmpeg` processes.
+    Finished segments are recorded in `base`, so an interrupted conversion
+    continues with the missing segments when called again.
+
+    :param vname: File name of the video in the `data` folder.
+    :type vname: str
+    :param base: Image folder.
+    :type base: str
+    :param workers: Number of `ffmpeg` processes. Default is the number of
+     CPUs.
+    :type workers: int
+    :param segments: Number of segments. Default is `workers`.
+    :type segments: int
+    :return: None.
+    :raises IOError: if some segments could not be converted. The other
+     segments are kept.
+    """
+    fname = "data" + os.sep + vname
     print("Converting '%s' to image sequence" % vname)
     if not os.path.exists(base):
         os.makedirs(base, exist_ok=True)
-    os.system('ffmpeg -i "%s" -q:v 1 %s%sframe'
-              % ("data" + os.sep + vname, base, os.sep) + "%08d.jpg")
+    cpus = os.cpu_count() or 1
+    workers = cpus if workers is None else workers
+    pname = _conversion_plan(base)
+    if os.path.exists(pname):
+        with open(pname) as f:
+            plan = json.load(f)
+    else:
+        n, _, fps = _probe_video(fname)
+        bounds = numpy.linspace(0, n, (segments or workers) + 1).round()
+        plan = {'frames': n, 'fps': fps, 'segments': [
+            (int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]}
+        with open(pname + '.tmp', 'w') as f:
+            json.dump(plan, f)
+        os.replace(pname + '.tmp', pname)
+    last = plan['segments'][-1]
+    todo = [tuple(seg) for seg in plan['segments']
+            if not os.path.exists(_segment_marker(base, *seg))]
+    if not todo:
+        return
+    threads = max(1, cpus // min(workers, len(todo)))
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        futures = [ex.submit(_convert_segment, fname, base, start, end,
+                             plan['fps'], [start, end] == list(last),
+                             threads)
+                   for start, end in todo]
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except IOError as e:
+                errors.append(str(e))
+    if errors:
+        raise IOError("%d of %d segments failed:\n%s"
+                      % (len(errors), len(plan['segments']),
+                         "\n".join(errors)))
 
 
 def unarchive_imgseq(src, base):
     for s in src:
+        open(s + '.extracting', 'w').close()
         with zipfile.ZipFile(s) as archive:
             trg = base[:base.find(os.sep)]
             print("Extracting %d images from '%s' to '%s'"
                   % (len(archive.filelist), s, trg))
             archive.extractall(path=trg)
+        open(s + '.extracted', 'w').close()
+        os.remove(s + '.extracting')
 
 
 img_format_labels = [
@@ -99,7 +395,484 @@ class ImageFormatError(Exception):
     pass
 
 
-def imgseq(run, cam):
+def _probe_video(fname):
+    """Frame count, frame shape and frame rate of the first video stream in
+    `fname`, as reported by `ffprobe`."""
+    def probe(*extra):
+        out = subprocess.run(
+            [ffprobe, '-v', 'error', '-select_streams', 'v:0'] + list(extra)
+            + ['-show_entries', 'stream=width,height,avg_frame_rate,nb_frames,'
+               'nb_read_packets', '-of', 'json', fname],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return json.loads(out.stdout.decode())['streams'][0]
+    st = probe()
+    if not str(st.get('nb_frames', '')).isdigit():
+        st = probe('-count_packets')
+        st['nb_frames'] = st['nb_read_packets']
+    num, den = st['avg_frame_rate'].split('/')
+    return (int(st['nb_frames']), (int(st['height']), int(st['width'])),
+            float(num) / float(den))
+
+
+class VideoSequence(pims.FramesSequence):
+    """Gray scale frames of a video file, decoded by `ffmpeg` and piped
+    directly into numpy arrays. Supports `len()` and slicing like
+    `pims.ImageSequence`, without converting the video to image files first.
+
+    Frames are read sequentially from an `ffmpeg` process; accessing a frame
+    other than the next one restarts decoding with a seek to that frame.
+    Gray values are the luma (Y) plane of the video, which differs slightly
+    from the RGB weighting of `pims` `as_grey`.
+
+    .. attribute:: filename
+
+        Path of the video file.
+
+    .. attribute:: fps
+
+        Frame rate of the video.
+    """
+    def __init__(self, filename, dtype=numpy.uint8):
+        """See above.
+
+        :param filename: Video file.
+        :param dtype: Data type of the returned frames. Values are always
+         8 bit.
+        """
+        self._proc, self._pos = None, None
+        self.filename = filename
+        self.source_files = [filename]
+        self._len, self._shape, self.fps = _probe_video(filename)
+        self._dtype = numpy.dtype(dtype)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_proc'], state['_pos'] = None, None
+        return state
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def frame_shape(self):
+        return self._shape
+
+    @property
+    def pixel_type(self):
+        return self._dtype
+
+    def _open(self, i):
+        self._close()
+        cmd = [ffmpeg, '-v', 'error', '-nostdin']
+        if i > 0:
+            cmd += ['-ss', '%.6f' % ((i - .5) / self.fps)]
+        cmd += ['-i', self.filename, '-vsync', '0', '-f', 'rawvideo',
+                '-pix_fmt', 'gray', '-']
+        self._proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            bufsize=self._shape[0] * self._shape[1])
+        self._pos = i
+
+    def _close(self):
+        if self._proc is not None:
+            self._proc.stdout.close()
+            self._proc.kill()
+            self._proc.wait()
+            self._proc, self._pos = None, None
+
+    def get_frame(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("Frame %d out of range" % i)
+        if self._proc is None or self._pos != i:
+            self._open(i)
+        frame = numpy.empty(self._shape, dtype=numpy.uint8)
+        buf, n = memoryview(frame).cast('B'), 0
+        while n < frame.nbytes:
+            k = self._proc.stdout.readinto(buf[n:])
+            if not k:
+                self._close()
+                raise IOError("Could not decode frame %d of '%s'"
+                              % (i, self.filename))
+            n += k
+        self._pos += 1
+        if self._dtype != frame.dtype:
+            frame = frame.astype(self._dtype)
+        return pims.Frame(frame, frame_no=i)
+
+    def close(self):
+        self._close()
+        super(VideoSequence, self).close()
+
+    def __del__(self):
+        self._close()
+
+
+def _natural_key(s):
+    """Sort key that orders numbered file names by their numbers."""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', s)]
+
+
+class GreyImageSequence(pims.FramesSequence):
+    """Image files read as grey scale frames, by default in their native
+    integer pixel type (8 bit images as `uint8`, 16 bit images as `uint16`)
+    instead of float64. This takes an eighth of the memory for 8 bit images,
+    and brightness sums of integer frames are exact.
+
+    Colour images are converted with the weights of `pims` `as_grey` and
+    rounded to 8 bit grey levels, unless a floating point `dtype` is given.
+
+    For quick previews frames can be read at 1/2, 1/4 or 1/8 of their
+    resolution. JPEG images are then decoded at reduced size directly (DCT
+    scaling, which is much faster than a full decode; colour JPEGs give the
+    luma channel), other images are averaged over `scale` x `scale` pixel
+    blocks. `luminance.cumul_bright_sequence()` converts the sums of reduced
+    frames to full resolution equivalents.
+
+    .. attribute:: pathname
+
+        Glob pattern of the image files.
+
+    .. attribute:: scale
+
+        Reduction factor of the frames.
+
+    .. attribute:: full_shape
+
+        Frame shape at full resolution.
+    """
+    def __init__(self, pattern, scale=1, dtype=None):
+        """See above.
+
+        :param pattern: Glob pattern of the image files, e.g.
+         'data/run/*.jpg'. Files are ordered by the numbers in their names.
+        :param scale: 1, 2, 4 or 8.
+        :param dtype: Data type of the returned frames. Default is the pixel
+         type of the images.
+        """
+        if not show_warnings:
+            warnings.simplefilter("ignore", UserWarning)
+        self.pathname = pattern
+        self.scale = _check_scale(scale)
+        self._dtype = None if dtype is None else numpy.dtype(dtype)
+        self._filepaths = sorted(glob.glob(pattern), key=_natural_key)
+        if len(self._filepaths) == 0:
+            raise IOError("No files were found matching '%s'." % pattern)
+        with Image.open(self._filepaths[0]) as img:
+            self.full_shape = img.size[::-1]
+        first = _read_grey(self._filepaths[0], scale, self._dtype)
+        self._shape, self._dtype = first.shape, first.dtype
+
+    def __len__(self):
+        return len(self._filepaths)
+
+    @property
+    def frame_shape(self):
+        return self._shape
+
+    @property
+    def pixel_type(self):
+        return self._dtype
+
+    def get_frame(self, i):
+        return pims.Frame(_read_grey(self._filepaths[i], self.scale,
+                                     self._dtype), frame_no=i)
+
+
+def _check_scale(scale):
+    if scale not in (1, 2, 4, 8):
+        raise ValueError("Scale must be 1, 2, 4 or 8, got %s" % scale)
+    return scale
+
+
+def _block_mean(frame, scale):
+    """Averages `frame` over blocks of `scale` x `scale` pixels (smaller at
+    the lower and right edges), keeping its pixel type."""
+    h, w = frame.shape
+    hr, wr = -(-h // scale), -(-w // scale)
+    acc = numpy.int64 if frame.dtype.kind in 'uib' else numpy.float64
+    padded = numpy.zeros((hr * scale, wr * scale), dtype=acc)
+    padded[:h, :w] = frame
+    sums = padded.reshape(hr, scale, wr, scale).sum(axis=(1, 3))
+    counts = numpy.outer(numpy.minimum(h - scale * numpy.arange(hr), scale),
+                         numpy.minimum(w - scale * numpy.arange(wr), scale))
+    ret = sums / counts
+    if frame.dtype.kind in 'ui':
+        ret = numpy.rint(ret)
+    return ret.astype(frame.dtype)
+
+
+_grey_weights = (0.2125, 0.7154, 0.0721)
+"""RGB weights of grey values, as used by `pims` `as_grey`."""
+
+
+def _read_grey(f, scale=1, dtype=None):
+    """Reads an image (file name or file object) as grey scale array at
+    1/`scale` of its resolution. Without `dtype` the array has the integer
+    pixel type of the image (see `GreyImageSequence`). With a floating point
+    `dtype` colour images are converted without rounding."""
+    exact = dtype is not None and numpy.dtype(dtype).kind == 'f'
+    with Image.open(f) as img:
+        w, h = img.size
+        if scale > 1 and img.format == 'JPEG':
+            img.draft('L', (max(w // scale, 1), max(h // scale, 1)))
+        if img.mode in ('L', 'I', 'F') or img.mode.startswith('I;16'):
+            ret = numpy.asarray(img)
+        elif exact:
+            ret = numpy.asarray(img.convert('RGB'), dtype=numpy.float64) \
+                .dot(_grey_weights)
+        else:
+            ret = numpy.asarray(img.convert('RGB').convert(
+                'L', _grey_weights + (0,)))
+    if scale > 1 and ret.shape == (h, w):
+        ret = _block_mean(ret, scale)
+    elif ret.shape != (-(-h // scale), -(-w // scale)):
+        raise IOError("Could not read image at 1/%d scale: got shape %s "
+                      "from %s" % (scale, ret.shape, (h, w)))
+    if dtype is not None and ret.dtype != dtype:
+        ret = ret.astype(dtype)
+    return ret
+
+
+class ZipSequence(pims.FramesSequence):
+    """Grey scale frames read directly from the image files inside one or
+    more zip archives, without extracting them. Members of all archives are
+    ordered by the numbers in their names. Frames are decoded like those of
+    `GreyImageSequence`, and converted to `dtype` if given.
+
+    Archives are opened on first access in every process (and, with the
+    thread backend, every thread), so the sequence can be sliced and handed
+    to `luminance.cumul_bright_sequence()` like any other sequence.
+
+    .. attribute:: source_files
+
+        The zip archives.
+
+    .. attribute:: scale
+
+        Reduction factor of the frames (see `GreyImageSequence`).
+
+    .. attribute:: full_shape
+
+        Frame shape at full resolution.
+    """
+    def __init__(self, archives, dtype=None, scale=1):
+        """See above.
+
+        :param archives: File name of a zip archive, or list of them.
+        :param dtype: Data type of the returned frames. Default is the pixel
+         type of the images.
+        :param scale: 1, 2, 4 or 8.
+        """
+        self.scale = _check_scale(scale)
+        if isinstance(archives, str):
+            archives = [archives]
+        self.source_files = list(archives)
+        members = []
+        for k, fname in enumerate(self.source_files):
+            with zipfile.ZipFile(fname) as archive:
+                members += [(name, k) for name in archive.namelist()
+                            if name[name.rfind('.') + 1:]
+                            in img_format_labels]
+        if len(members) == 0:
+            raise ImageFormatError("No image files found in %s"
+                                   % self.source_files)
+        members.sort(key=lambda m: _natural_key(m[0]))
+        self._members = [m[0] for m in members]
+        self._archive = numpy.array([m[1] for m in members], dtype=numpy.int32)
+        self._handles, self._pid = {}, None
+        self._dtype = None if dtype is None else numpy.dtype(dtype)
+        with Image.open(io.BytesIO(self._read(0))) as img:
+            self.full_shape = img.size[::-1]
+        first = self.get_frame(0)
+        self._shape, self._dtype = first.shape, first.dtype
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'], state['_pid'] = {}, None
+        return state
+
+    def __len__(self):
+        return len(self._members)
+
+    @property
+    def frame_shape(self):
+        return self._shape
+
+    @property
+    def pixel_type(self):
+        return self._dtype
+
+    def _handle(self, k):
+        if self._pid != os.getpid():
+            # File positions are shared with the parent after a fork.
+            self._handles, self._pid = {}, os.getpid()
+        if k not in self._handles:
+            self._handles[k] = zipfile.ZipFile(self.source_files[k])
+        return self._handles[k]
+
+    def _read(self, i):
+        return self._handle(int(self._archive[i])).read(self._members[i])
+
+    def get_frame(self, i):
+        return pims.Frame(_read_grey(io.BytesIO(self._read(i)), self.scale,
+                                     self._dtype), frame_no=i)
+
+    def close(self):
+        for h in self._handles.values():
+            h.close()
+        self._handles = {}
+        super(ZipSequence, self).close()
+
+
+def _rawstack_meta(fname):
+    return fname + '.json'
+
+
+def save_rawstack(seq, fname, fps=None, run=None, cam=None, dtype=None):
+    """Stores the frames of `seq` as one uncompressed frame stack (`.npy`
+    format) plus a small JSON header with shape, fps, run and camera id. The
+    stack is decoded only once here; afterwards it can be opened with
+    `RawSequence`, without any image decoding.
+
+    :param seq: Image sequence.
+    :type seq: Slicerator
+    :param fname: Target file name, typically ending with `.npy`.
+    :type fname: str
+    :param fps: Frame rate. Taken from `seq` if it has an `fps` attribute.
+    :type fps: float
+    :param run: Experiment id.
+    :type run: str
+    :param cam: Camera id.
+    :type cam: str
+    :param dtype: Pixel type of the stack. Default is the pixel type of
+     integer frames, and `uint8` for floating point frames. Values that do
+     not fit an integer type are clipped to its range (floating point frames
+     are rounded first).
+    :type dtype: numpy.dtype
+    :return: The stored sequence.
+    :rtype: RawSequence
+    """
+    first = numpy.asarray(seq[0])
+    if dtype is None:
+        dtype = first.dtype if first.dtype.kind in 'ui' else numpy.uint8
+    dtype = numpy.dtype(dtype)
+    if fps is None:
+        fps = getattr(seq, 'fps', None)
+    shape = (len(seq),) + first.shape
+    tmp = fname + '.tmp'
+    out = numpy.lib.format.open_memmap(tmp, mode='w+', dtype=dtype,
+                                       shape=shape)
+    lim = numpy.iinfo(dtype) if dtype.kind in 'ui' else None
+    for i, frame in enumerate(seq):
+        frame = numpy.asarray(frame)
+        if lim is not None and frame.dtype.kind == 'f':
+            frame = numpy.clip(numpy.rint(frame), lim.min, lim.max)
+        elif lim is not None and frame.dtype.kind in 'ui' \
+                and not numpy.can_cast(frame.dtype, dtype):
+            frame = numpy.clip(frame, lim.min, lim.max)
+        out[i] = frame
+    out.flush()
+    del out
+    with open(_rawstack_meta(fname), 'w') as f:
+        json.dump({'shape': shape, 'dtype': dtype.str, 'fps': fps,
+                   'run': run, 'cam': cam}, f)
+    os.replace(tmp, fname)
+    return RawSequence(fname)
+
+
+class RawSequence:
+    """Frame stack written by `save_rawstack()`, opened as `numpy.memmap`.
+    Frames are views into the mapped file, so reading them involves neither
+    decoding nor copying. Slicing returns another `RawSequence`; when pickled
+    (e.g. to be sent to a worker process) only the file name and the frame
+    indices are transferred, and the file is mapped again on first access.
+
+    .. attribute:: filename
+
+        Path of the frame stack.
+
+    .. attribute:: meta
+
+        Header dict with 'shape', 'dtype', 'fps', 'run' and 'cam'.
+    """
+    def __init__(self, fname, indices=None):
+        """See above.
+
+        :param fname: Frame stack file.
+        :param indices: Frames of the stack this sequence refers to. Default
+         is all.
+        """
+        self.filename = fname
+        self.source_files = [fname]
+        with open(_rawstack_meta(fname)) as f:
+            self.meta = json.load(f)
+        self._data = None
+        if indices is None:
+            indices = range(self.meta['shape'][0])
+        self.indices = indices
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        """The complete memory mapped stack (all frames of the file)."""
+        if self._data is None:
+            self._data = numpy.load(self.filename, mmap_mode='r')
+        return self._data
+
+    @property
+    def fps(self):
+        return self.meta['fps']
+
+    @property
+    def frame_shape(self):
+        return tuple(self.meta['shape'][1:])
+
+    @property
+    def pixel_type(self):
+        return numpy.dtype(self.meta['dtype'])
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    def __len__(self):
+        return len(self.indices)
+
+    def root(self):
+        """The sequence of all frames in the file, sharing the mapping."""
+        ret = RawSequence.__new__(RawSequence)
+        ret.__dict__.update(self.__dict__)
+        ret.indices = range(self.meta['shape'][0])
+        return ret
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, numpy.integer)):
+            return self.data[self.indices[key]].view(numpy.ndarray)
+        ret = RawSequence.__new__(RawSequence)
+        ret.__dict__.update(self.__dict__)
+        if isinstance(key, slice):
+            ret.indices = self.indices[key]
+        else:
+            ret.indices = numpy.asarray(self.indices)[key]
+        return ret
+
+    def __iter__(self):
+        data = self.data
+        for i in self.indices:
+            yield data[i].view(numpy.ndarray)
+
+    def close(self):
+        self._data = None
+
+
+def imgseq(run, cam, video=False, raw=False, native=False, extract=True,
+           scale=1):
     """Load the image sequence given by `run` and `cam`. If not present in the
     `data` folder an image sequence is created from the original video. If that
     video is not present locally, it will be downloaded from the VHub dataset
@@ -109,9 +882,37 @@ def imgseq(run, cam):
     :type run: str
     :param cam: Camera id, as given by `show()`.
     :type cam: str
+    :param video: For video data sets, decode frames directly from the video
+     file (see `VideoSequence`) instead of converting it to JPEG images.
+    :type video: bool
+    :param raw: Return the sequence as memory mapped frame stack (see
+     `RawSequence`). The stack is written to `data` on first use, from the
+     image sequence or, with `video`, the video file.
+    :type raw: bool
+    :param native: Keep the frames of image files in their integer pixel type
+     (see `GreyImageSequence`) instead of converting them to float64.
+    :type native: bool
+    :param extract: For zip archive data sets, extract the images. Otherwise
+     frames are read from the archives (see `ZipSequence`).
+    :type extract: bool
+    :param scale: Preview mode: read image frames at 1/2, 1/4 or 1/8 of
+     their resolution (see `GreyImageSequence`). Not available for `raw`
+     and `video` sequences.
+    :type scale: int
     :return: The image sequence.
-    :rtype: pims.ImageSequence
+    :rtype: GreyImageSequence, ZipSequence, VideoSequence or RawSequence
     """
+    if scale != 1 and (raw or video):
+        raise ValueError("Reduced scale frames are only available for image "
+                         "sequences")
+    if raw:
+        fname = "data%s%s_%s.npy" % (os.sep, run, cam)
+        if not (os.path.exists(fname)
+                and os.path.exists(_rawstack_meta(fname))):
+            print("Writing frame stack '%s'" % fname)
+            save_rawstack(imgseq(run, cam, video=video, native=True), fname,
+                          run=run, cam=cam)
+        return RawSequence(fname)
     dta = vhub_links[run][cam]
     try:
         fmt = dta['format']
@@ -126,20 +927,34 @@ def imgseq(run, cam):
         camlabel = camlabel[:-14]
     camlabel = camlabel[camlabel.rfind('_') + 1:]
     base = "data%s%s_%s%s" % (os.sep, run, camlabel, os.sep)
-    if not os.path.exists(base):
+    if video and fmt == "video_mp4":
+        return VideoSequence(download_dataset(run=run, cam=camlabel)[0])
+    if not extract and fmt == "zip-archive":
+        return ZipSequence(_archives(run, cam, base),
+                           dtype=None if native else numpy.float64,
+                           scale=scale)
+    if fmt == "zip-archive":
+        _mark_extracted(run, cam, base)
+    if not os.path.exists(base) \
+            or (fmt == "zip-archive" and _pending_parts(run, cam)) \
+            or (fmt == "video_mp4" and _conversion_pending(base)):
         if fmt == "video_mp4":
             if not os.path.exists(base + ".mp4"):
                 download_dataset(run=run, cam=camlabel)
             convert_video_to_imgseq(_videoname(run, cam), base)
         elif fmt == "zip-archive":
-            if not os.path.exists(base[:-1] + "-0.zip"):
-                src = download_dataset(run=run, cam=cam)
+            if not os.path.exists(base):
+                for _, trg in _dataset_targets(run, cam):
+                    if os.path.exists(trg + '.extracted'):
+                        os.remove(trg + '.extracted')
+            if not os.path.exists(base[:-1] + "-0.zip") \
+                    or _missing_parts(run, cam):
+                download_dataset(run=run, cam=cam, extract=base)
             else:
-                datadir = os.path.dirname(base[:-1])
-                src = [datadir + os.sep + f
-                       for f in os.listdir(datadir) if f.endswith('.zip')
-                       and os.path.basename(base[:-1]) in f]
-            unarchive_imgseq(src=src, base=base)
+                unarchive_imgseq(
+                    src=[a for a in _archives(run, cam, base)
+                         if not os.path.exists(a + '.extracted')],
+                    base=base)
         else:
             raise ValueError("Got an unknown format '%s' for run '%s', "
                              "cam '%s'" % (fmt, run, cam))
@@ -152,10 +967,72 @@ def imgseq(run, cam):
         raise ImageFormatError(
             "Did not find any valid image files in %s.\n"
             "Valid image types are: %s" % (base, img_format_labels))
-    if not show_warnings:
-        warnings.simplefilter("ignore", UserWarning)
-    ret = pims.ImageSequence(base + "*." + lbl, as_grey=True, dtype=numpy.float)
-    return ret
+    return image_sequence(base + "*." + lbl, native, scale)
+
+
+def image_sequence(pattern, native=False, scale=1):
+    """Opens the image files matching `pattern` the way `imgseq()` does, as
+    grey scale sequence of floating point frames.
+
+    :param pattern: Glob pattern of the image files, e.g. 'data/run/*.jpg'.
+    :type pattern: str
+    :param native: Keep integer pixel types (see `GreyImageSequence`).
+    :type native: bool
+    :param scale: Read frames at reduced resolution (see
+     `GreyImageSequence`); implies `native`.
+    :type scale: int
+    :rtype: GreyImageSequence
+    """
+    return GreyImageSequence(
+        pattern, scale, None if native or scale != 1 else numpy.float64)
+
+
+def _archives(run, cam, base):
+    """Zip archives of a data set: those found next to the image folder
+    `base`, or else the downloaded ones."""
+    if not os.path.exists(base[:-1] + "-0.zip"):
+        return download_dataset(run=run, cam=cam)
+    datadir = os.path.dirname(base[:-1])
+    return [datadir + os.sep + f
+            for f in os.listdir(datadir) if f.endswith('.zip')
+            and os.path.basename(base[:-1]) in f]
+
+
+def sequence_indices(seq):
+    """Splits a (possibly sliced) image sequence into the underlying reader
+    and the frame indices `seq` refers to.
+
+    :param seq: Image sequence, or a slice of one.
+    :type seq: Slicerator
+    :return: (reader, indices), where `indices` holds the positions in
+     `reader` of the frames in `seq`.
+    :rtype: tuple
+    """
+    if isinstance(seq, Slicerator):
+        return seq._ancestor, numpy.fromiter(seq.indices, dtype=numpy.int64,
+                                             count=len(seq))
+    if isinstance(seq, RawSequence):
+        return seq.root(), numpy.asarray(seq.indices, dtype=numpy.int64)
+    return seq, numpy.arange(len(seq), dtype=numpy.int64)
+
+
+def sequence_sources(seq):
+    """Files on disk which the frames of `seq` are read from.
+
+    :param seq: Image sequence, or a slice of one.
+    :type seq: Slicerator
+    :return: List of file names, one per frame for image files, or the files
+     of the whole sequence (e.g. a video). `None` if the sequence is not backed
+     by files.
+    :rtype: list or None
+    """
+    reader, idx = sequence_indices(seq)
+    if hasattr(reader, 'source_files'):
+        return [os.path.abspath(f) for f in reader.source_files]
+    files = getattr(reader, '_filepaths', None)
+    if files is None:
+        return None
+    return [os.path.abspath(files[i]) for i in idx]
 
 
 runs = [
@@ -1,29 +1,254 @@
 """All luminance related functions"""
+import hashlib as _hashlib
+import warnings as _warnings
 import numpy as _np
 from numpy import ndarray as _nda
 import multiprocessing as _mp
 import scipy.signal as _sig
+from functools import partial as _partial
+from scipy.interpolate import UnivariateSpline as _UnivariateSpline
+from . import load as _load
+from . import parallel as _par
+from . import cache as _cache
 
 _nprocs = _mp.cpu_count()
 
 
+class RegionMask:
+    """A region of interest of arbitrary shape, given by a boolean mask or a
+    weight image with the frames' shape. The mask is converted once to a
+    compact form: runs of selected pixels (as flat start/end positions) for
+    boolean masks, or flat pixel indices and weights for weight images. The
+    brightness of a frame is then computed with vectorized reductions that
+    touch only the rows covered by the region.
+
+    .. attribute:: shape
+
+        Frame shape the mask applies to.
+
+    .. attribute:: rows
+
+        (start, end) of the rows covered by the region.
+
+    .. attribute:: area
+
+        Number of selected pixels (sum of weights for weight images).
+    """
+    def __init__(self, mask):
+        """See above.
+
+        :param mask: Boolean mask, or weight image, of the frame shape.
+        """
+        mask = _np.asarray(mask)
+        if mask.ndim != 2:
+            raise ValueError("Region masks must be 2D, got shape %s"
+                             % (mask.shape,))
+        self.shape = mask.shape
+        rows = _np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            self.rows = (0, 0)
+        else:
+            self.rows = (int(rows[0]), int(rows[-1]) + 1)
+        block = mask[self.rows[0]:self.rows[1]].ravel()
+        if mask.dtype == bool or _np.all((block == 0) | (block == 1)):
+            self.weights, self.index = None, None
+            sel = (block != 0).astype(_np.int8)
+            edges = _np.flatnonzero(_np.diff(_np.concatenate(([0], sel, [0]))))
+            if len(edges) and edges[-1] == len(block):
+                edges = edges[:-1]
+            self.runs = edges
+            self.area = float(_np.count_nonzero(block))
+        else:
+            self.runs = None
+            self.index = _np.flatnonzero(block)
+            self.weights = block[self.index].astype(_np.float64)
+            self.area = float(self.weights.sum())
+
+    @classmethod
+    def from_polygon(cls, vertices, shape):
+        """Mask of all pixels whose centers lie inside a polygon (even-odd
+        rule).
+
+        :param vertices: Sequence of (row, column) vertex coordinates, in
+         pixels. Pixel (i, j) has its center at (i + 0.5, j + 0.5).
+        :type vertices: array_like
+        :param shape: Frame shape.
+        :type shape: tuple
+        :rtype: RegionMask
+        """
+        vert = _np.asarray(vertices, dtype=_np.float64)
+        h, w = shape
+        diff = _np.zeros((h, w + 1), dtype=_np.int32)
+        for (y0, x0), (y1, x1) in zip(vert, _np.roll(vert, -1, axis=0)):
+            if y0 == y1:
+                continue
+            lo, hi = min(y0, y1), max(y0, y1)
+            rows = _np.arange(max(int(_np.ceil(lo - .5)), 0),
+                              min(int(_np.ceil(hi - .5)), h))
+            if len(rows) == 0:
+                continue
+            xint = x0 + (rows + .5 - y0) * (x1 - x0) / (y1 - y0)
+            cols = _np.clip(_np.ceil(xint - .5), 0, w).astype(_np.intp)
+            diff[rows, 0] += 1
+            diff[rows, cols] -= 1
+        return cls(_np.cumsum(diff[:, :w], axis=1) % 2 == 1)
+
+    def image(self):
+        """The region as weight image of the frame shape.
+
+        :rtype: ndarray
+        """
+        ret = _np.zeros(self.shape, dtype=_np.float64)
+        block = ret[self.rows[0]:self.rows[1]].reshape(-1)
+        if self.weights is not None:
+            block[self.index] = self.weights
+        else:
+            starts, ends = self.runs[::2], self.runs[1::2]
+            if len(ends) < len(starts):
+                ends = _np.append(ends, len(block))
+            block[_intervals_mask(len(block), starts, ends)] = 1.
+        return ret
+
+    @property
+    def cache_key(self):
+        """Digest identifying the region (used by `cache.BrightnessCache`)."""
+        h = _hashlib.sha1(("%s%s" % (self.shape, self.rows)).encode())
+        for a in (self.runs, self.index, self.weights):
+            if a is not None:
+                h.update(a.tobytes())
+        return 'mask:' + h.hexdigest()
+
+    def sum(self, frame):
+        """Brightness of the region in `frame`."""
+        if frame.shape[:2] != self.shape:
+            raise ValueError("Frame shape %s does not match mask shape %s"
+                             % (frame.shape, self.shape))
+        block = _np.ravel(frame[self.rows[0]:self.rows[1]])
+        if self.weights is not None:
+            return _np.dot(block[self.index], self.weights)
+        if len(self.runs) == 0:
+            return 0.
+        return _np.add.reduceat(block, self.runs,
+                                dtype=_accumulator(block))[::2].sum()
+
+
+def _accumulator(frame):
+    """Data type to sum the pixels of `frame` in: 64 bit integers for integer
+    frames, so their sums are exact, float64 otherwise."""
+    kind = frame.dtype.kind
+    if kind == 'u':
+        return _np.uint64
+    if kind in 'ib':
+        return _np.int64
+    return _np.float64
+
+
+def _is_rect(select):
+    """Tells whether `select` is a single ((start0, end0), (start1, end1))
+    rectangle, also when given as nested lists (e.g. read from JSON)."""
+    return isinstance(select, (list, tuple)) and len(select) == 2 and all(
+        isinstance(p, (list, tuple)) and len(p) == 2
+        and all(isinstance(i, (int, _np.integer)) for i in p)
+        for p in select)
+
+
+def _prepare_select(select):
+    """Converts masks and weight images in `select` to `RegionMask` objects
+    and rectangles given as lists to tuples, keeping the list/dict
+    structure."""
+    if _is_rect(select):
+        return tuple(tuple(p) for p in select)
+    if isinstance(select, _np.ndarray):
+        return RegionMask(select)
+    if isinstance(select, dict):
+        return {k: _prepare_select(v) for k, v in select.items()}
+    if isinstance(select, list):
+        return [_prepare_select(v) for v in select]
+    return select
+
+
+def _scaled_select(select, shape, scale):
+    """Maps selection(s) on frames of `shape` to frames read at 1/`scale`
+    resolution. Each reduced pixel (the mean of a `scale` x `scale` block) is
+    weighted with the number of selected full resolution pixels it covers,
+    so sums over the reduced frames estimate the full resolution sums."""
+    if isinstance(select, dict):
+        return {k: _scaled_select(v, shape, scale) for k, v in select.items()}
+    if isinstance(select, list) and not _is_rect(select):
+        return [_scaled_select(v, shape, scale) for v in select]
+    if select is None:
+        img = _np.ones(shape)
+    elif isinstance(select, RegionMask):
+        img = select.image()
+    else:
+        img = _np.zeros(shape)
+        ((start0, end0), (start1, end1)) = select
+        img[start0:end0, start1:end1] = 1.
+    h, w = shape
+    return RegionMask(_np.add.reduceat(
+        _np.add.reduceat(img, _np.arange(0, h, scale), axis=0),
+        _np.arange(0, w, scale), axis=1))
+
+
+def _selections(select):
+    """Normalizes a selection argument to a list of single selections.
+
+    :param select: `None`, a single ((start0, end0), (start1, end1)) tuple, or
+     a list or dict of these.
+    :return: (selections, multi) where `selections` is a list of single
+     selections and `multi` tells whether `select` named several regions.
+    :rtype: tuple
+    """
+    if isinstance(select, dict):
+        return list(select.values()), True
+    if isinstance(select, list) and not _is_rect(select):
+        return list(select), True
+    return [select], False
+
+
+def _per_region(value, select):
+    """Converts a per region parameter given as dict (keyed like `select`) to
+    an array with the regions' column order. Lists are converted to arrays,
+    other values are returned unchanged."""
+    if isinstance(value, dict) and isinstance(select, dict):
+        return _np.array([value[k] for k in select.keys()], dtype=_np.float64)
+    if isinstance(value, list):
+        return _np.asarray(value, dtype=_np.float64)
+    return value
+
+
+def _cbright_one(frame, select):
+    if select is None:
+        return frame.sum(dtype=_accumulator(frame))
+    if isinstance(select, RegionMask):
+        return select.sum(frame)
+    if isinstance(select, _np.ndarray):
+        return RegionMask(select).sum(frame)
+    ((start0, end0), (start1, end1)) = select
+    return frame[start0:end0, start1:end1].sum(dtype=_accumulator(frame))
+
+
 def cumul_bright(frame, select=None):
     """Computes the cumulative, relative luminance of an image.
 
-    :param frame: Image to compute the luminance from.
+    :param frame: Image to compute the luminance from. Integer frames (see
+     `load.GreyImageSequence`) are summed exactly in 64 bit integers.
     :type frame: ndarray
     :param select: ((start0, end0), (start1, end1)). Optional, to select subset
-     of `frame`.
-    :type select: tuple
-    :return: Brightness of frame.
-    :rtype: float
+     of `frame`. Regions of other shapes can be given as `RegionMask`, or as
+     boolean mask or weight image of the frame's shape. A list or dict of such
+     selections computes the brightness of several regions at once; `None`
+     entries stand for the whole frame.
+    :type select: tuple, RegionMask, ndarray, list or dict
+    :return: Brightness of frame, or one brightness value per region if
+     `select` is a list or dict (in list or key order).
+    :rtype: float or ndarray
     """
-    if select is None:
-        start0, start1 = 0, 0
-        end0, end1 = frame.shape
-    else:
-        ((start0, end0), (start1, end1)) = select
-    return frame[start0:end0, start1:end1].sum()
+    sels, multi = _selections(select)
+    if not multi:
+        return _cbright_one(frame, select)
+    return _np.array([_cbright_one(frame, sel) for sel in sels],
+                     dtype=_np.float64)
 
 
 def luminance(frame, fov, ref, noise, select=None):
@@ -39,107 +264,262 @@ def luminance(frame, fov, ref, noise, select=None):
     :type noise: `float`
     :param select: Selection marking the subset of `frame` to compute the
      luminance from.
-    :type select: `tuple` or `None`
+    :type select: `tuple`, `RegionMask` or `None`
     :return: luminance of `frame`.
     :rtype: `float`
     """
     return fov * (cumul_bright(frame, select) - noise) / (ref - noise)
 
 
-def _cbright_chunk(chunk, select, start, end, que):
-    """**Do not call this directly.**
-     Computes the cumulative brightness for a part of an image sequence. This
-     method should is called multiple times from `cumul_bright_sequence()` in
-     separate processes.
-
-    :param chunk: Complete or partial image  sequence.
-    :type chunk: Slicerator
-    :param select: Selection marking the subset of `frame` to compute the
-     luminance from.
-    :type select: tuple
-    :param start: Start position in sequence from which `chunk` was selected.
-    :type start: int
-    :param end: End position in sequence from which `chunk` was selected.
-    :type end: int
-    :param que: The queue object that manages the multiple processes.
-    :type que: multiprocessing.Queue
-    :return: None.
-    """
-    act = _np.empty(len(chunk), dtype=_np.float)
-    for i, frame in enumerate(chunk):
-        act[i] = cumul_bright(frame, select)
-    que.put((act, start, end))
-
-
-def cumul_bright_sequence(seq, select=None, processes=_nprocs):
+def cumul_bright_sequence(seq, select=None, processes=_nprocs, cache=None,
+                          executor=None, progress=None, stats=False,
+                          backend='processes', checkpoint=None):
     """Compute the cumulative brightness of each frame in `seq` using the
     `luminance()` function. Arguments other than `seq` and `processes are
     passed unmodified to `cumul_brightness()`.
 
+    Several regions can be evaluated in the same pass over the sequence by
+    passing a list or dict of selections as `select`. Each frame is then
+    decoded once, and the result gets one column per region.
+
+    For sequences read at reduced resolution (preview mode, see
+    `load.GreyImageSequence`) selections are given in full resolution
+    pixels. They are mapped to the reduced frames, and the brightness is
+    scaled to full resolution equivalents.
+
+    The frames are processed by a pool of worker processes that is kept alive
+    between calls (see `parallel.get_executor()`), or with `backend='threads'`
+    by reader threads in this process (see `parallel.ThreadExecutor`).
+
+    With a `checkpoint` folder, finished chunks are saved as they come in
+    (see `cache.Checkpoint`). If the call is interrupted, calling it again
+    with the same arguments only computes the missing frames. The checkpoint
+    is removed once the result is complete.
+
     :param seq: Image sequence to compute the luminance from.
     :type seq: Slicerator
     :param select: ((start0, end0), (start1, end1)). Optional, to select subset
-     of a frame in `seq`.
-    :type select: tuple
+     of a frame in `seq`. Also a `RegionMask`, a boolean mask or weight image,
+     or a list or dict of such selections (see `cumul_bright()`). Masks are
+     converted to `RegionMask` once for the whole sequence.
+    :type select: tuple, RegionMask, ndarray, list or dict
     :param processes: Number of system processes to use. Default is number of
      system CPUs.
     :type processes: int
-    :return: brightness array B(t)
-    :rtype: ndarray
+    :param cache: Optional cache to look up the result in before reading any
+     frames, and to store it in afterwards.
+    :type cache: cache.BrightnessCache
+    :param executor: Worker pool to use instead of the shared pool with
+     `processes` workers.
+    :type executor: parallel.SequenceExecutor
+    :param progress: Function called with a `parallel.SequenceStats` object
+     each time a chunk of frames is done.
+    :type progress: callable
+    :param stats: Also return the `parallel.SequenceStats` of the run, with
+     per-stage times and per-worker throughput.
+    :type stats: bool
+    :param backend: 'processes' or 'threads'. Ignored if `executor` is given.
+    :type backend: str
+    :param checkpoint: Folder to keep partial results in. Sequences that are
+     not backed by files are computed without checkpoint.
+    :type checkpoint: str
+    :return: brightness array B(t); of shape (frames, regions) if `select` is
+     a list or dict. With `stats` the tuple (B(t), stats); its frame counts
+     only include the frames computed in this call.
+    :rtype: ndarray or tuple
+    :raises parallel.WorkerError: if reading or processing a frame fails.
+    """
+    if cache is not None:
+        act = cache.get(seq, select)
+        if act is not None:
+            if not stats:
+                return act
+            st = _par.SequenceStats(len(act))
+            st.done, st.cached = len(act), True
+            st._tick()
+            return act, st
+    key = select
+    select = _prepare_select(select)
+    reader = _load.sequence_indices(seq)[0]
+    if getattr(reader, 'scale', 1) != 1:
+        select = _scaled_select(select, reader.full_shape, reader.scale)
+    sels, multi = _selections(select)
+    shape = (len(sels),) if multi else ()
+    if executor is None:
+        executor = _par.get_executor(processes, backend)
+    func = _partial(cumul_bright, select=select)
+    ckpt = None if checkpoint is None else \
+        _cache.checkpoint(checkpoint, seq, key, shape)
+    if ckpt is None:
+        act = executor.map_frames(seq, func, shape=shape, dtype=_np.float64,
+                                  progress=progress, stats=stats)
+    else:
+        todo = ckpt.missing()
+
+        def save(start, end, values):
+            ckpt.save(todo[start:end], values)
+
+        part = seq if len(todo) == len(seq) else seq[todo.tolist()]
+        act = executor.map_frames(part, func, shape=shape,
+                                  dtype=_np.float64, progress=progress,
+                                  stats=stats, on_chunk=save)
+    if stats:
+        act, st = act
+    if ckpt is not None:
+        act = ckpt.result()
+        ckpt.remove()
+    if cache is not None:
+        cache.put(seq, act, key)
+    return (act, st) if stats else act
+
+
+def _intervals_mask(n, starts, ends):
+    """Boolean array of length `n` that is True in [start, end) for all
+    pairs of `starts` and `ends`."""
+    delta = _np.zeros(n + 1, dtype=_np.int64)
+    _np.add.at(delta, starts, 1)
+    _np.add.at(delta, ends, -1)
+    return _np.cumsum(delta[:-1]) > 0
+
+
+def adaptive_cbright_sequence(seq, select=None, step=16, tol=None,
+                              noise_frames=None, margin=1, interpolate=True,
+                              processes=_nprocs, cache=None, executor=None,
+                              backend='processes'):
+    """Cumulative brightness of `seq`, computed at full time resolution only
+    where it is needed. First every `step`-th frame (and the noise window) is
+    evaluated. Intervals between these samples are then evaluated frame by
+    frame if the brightness changes by more than `tol` across them, bends
+    by more than `tol` (second differences), or leaves the noise band
+    B0 +- `tol`. All other frames are interpolated linearly, so they carry
+    the trend of the signal but not its frame to frame noise.
+
+    This saves reading most frames of long, mostly quiet recordings. Events
+    shorter than `step` frames that fall completely between two samples are
+    not detected, so `step` should be shorter than the fastest feature of
+    interest.
+
+    :param seq: Image sequence.
+    :type seq: Slicerator
+    :param select: Selection(s), see `cumul_bright_sequence()`.
+    :type select: tuple, RegionMask, ndarray, list or dict
+    :param step: Spacing of the coarse samples, in frames.
+    :type step: int
+    :param tol: Tolerated brightness error, per region for multiple
+     selections. Default is three times the standard deviation of the noise
+     window, or without one, three times the noise estimated from the
+     coarse samples (see `noise_sigma()`).
+    :type tol: float or ndarray
+    :param noise_frames: Frames of the pre-event background, as number of
+     frames from the start or slice. They are always evaluated, and define
+     the noise level B0.
+    :type noise_frames: int or slice
+    :param margin: Number of coarse intervals evaluated in addition on
+     either side of each detected interval.
+    :type margin: int
+    :param interpolate: Interpolate frames that were not evaluated. If
+     False, they are NaN.
+    :type interpolate: bool
+    :param processes: Number of worker processes.
+    :type processes: int
+    :param cache: Optional brightness cache.
+    :type cache: cache.BrightnessCache
+    :param executor: Worker pool to use instead of the shared pool.
+    :type executor: parallel.SequenceExecutor
+    :param backend: 'processes' or 'threads'.
+    :type backend: str
+    :return: (B(t), measured), where `measured` is a boolean array that is
+     True for the frames that were evaluated.
+    :rtype: tuple
     """
-    itms_per_proc, rem = len(seq) // processes, len(seq) % processes
-    que = _mp.Queue()
-    start, end, procs, idx = 0, -1, [], []
-    for k in range(processes):
-        end = start + itms_per_proc
-        p = _mp.Process(
-            target=_cbright_chunk,
-            args=(seq[start:end], select, start, end, que))
-        procs.append(p)
-        start = end
-        p.start()
-    p = _mp.Process(
-        target=_cbright_chunk,
-        args=(seq[start:], select, start, len(seq), que))
-    procs.append(p)
-    p.start()
-    act = _np.empty(len(seq), dtype=_np.float)
-    for _ in range(len(procs)):
-        chunk, start, end = que.get()
-        try:
-            act[start:end] = chunk
-        except ValueError:
-            print("chunk:", chunk)
-            print("start:", start, "end:", end)
-            raise
-    for p in procs:
-        p.join()
-    return act
-
-
-def average_cbright(chunk, select=None, uncert=False, nprocs=_nprocs):
+    n = len(seq)
+    select = _prepare_select(select)
+    sels, multi = _selections(select)
+    out = _np.full((n, len(sels)), _np.nan)
+    measured = _np.zeros(n, dtype=bool)
+
+    def measure(mask):
+        idx = _np.flatnonzero(mask & ~measured)
+        if len(idx):
+            act = cumul_bright_sequence(
+                seq[[int(i) for i in idx]], select, processes, cache=cache,
+                executor=executor, backend=backend)
+            out[idx] = _np.reshape(act, (len(idx), len(sels)))
+            measured[idx] = True
+
+    coarse = _np.zeros(n, dtype=bool)
+    coarse[::max(int(step), 1)] = True
+    coarse[-1:] = True
+    window = None
+    if noise_frames is not None:
+        if not isinstance(noise_frames, slice):
+            noise_frames = slice(0, int(noise_frames))
+        window = _np.arange(n)[noise_frames]
+        coarse[window] = True
+    measure(coarse)
+    pos = _np.flatnonzero(measured)
+    val = out[pos]
+    if tol is None:
+        if window is not None and len(window):
+            tol = 3 * out[window].std(axis=0)
+        else:
+            tol = 3 * _np.array([noise_sigma(v) if len(v) > 2 else 0.
+                                 for v in val.T])
+    tol = _np.broadcast_to(_per_region(tol, select), (len(sels),))
+    flag = _np.zeros(max(len(pos) - 1, 0), dtype=bool)
+    flag |= (_np.abs(_np.diff(val, axis=0)) > tol).any(axis=1)
+    if len(pos) > 2:
+        bend = (_np.abs(val[:-2] - 2 * val[1:-1] + val[2:]) / 2 > tol).any(
+            axis=1)
+        flag[:-1] |= bend
+        flag[1:] |= bend
+    if window is not None and len(window):
+        outside = (_np.abs(val - out[window].mean(axis=0)) > tol).any(axis=1)
+        flag |= outside[:-1] | outside[1:]
+    if margin > 0:
+        grown = flag.copy()
+        for k in range(1, margin + 1):
+            grown[k:] |= flag[:-k]
+            grown[:-k] |= flag[k:]
+        flag = grown
+    measure(_intervals_mask(n, pos[:-1][flag], pos[1:][flag] + 1))
+    if interpolate and not measured.all():
+        pos = _np.flatnonzero(measured)
+        t = _np.arange(n)
+        for j in range(len(sels)):
+            out[:, j] = _np.interp(t, pos, out[pos, j])
+    return (out if multi else out[:, 0]), measured
+
+
+def average_cbright(chunk, select=None, uncert=False, nprocs=_nprocs,
+                    cache=None):
     """Convenience method to compute the average cumulative brightness of
     given image sequence selection. Useful to determine the noise level.
 
     :param chunk: Image sequence/chunk.
     :type chunk: Slicerator
-    :param select: Selection of images to work on.
-    :type select: tuple
+    :param select: Selection of images to work on, or list or dict of
+     selections (see `cumul_bright_sequence()`).
+    :type select: tuple, list or dict
     :param uncert: Whether to return standard deviation alongside average value.
     :type uncert: bool
     :param nprocs: Number of processes to use.
     :type nprocs: int
-    :return: Averaged brightness.
-    :rtype: float
+    :param cache: Optional brightness cache.
+    :type cache: cache.BrightnessCache
+    :return: Averaged brightness; one value per region for multiple
+     selections.
+    :rtype: float or ndarray
     """
-    ret = cumul_bright_sequence(chunk, select, nprocs)
+    ret = cumul_bright_sequence(chunk, select, nprocs, cache=cache)
     if uncert:
-        return ret.mean(), ret.std()
+        return ret.mean(axis=0), ret.std(axis=0)
     else:
-        return ret.mean()
+        return ret.mean(axis=0)
 
 
-def luminance_sequence(seq, fov, ref, noise, select=None, processes=_nprocs):
+def luminance_sequence(seq, fov, ref, noise, select=None, processes=_nprocs,
+                       cache=None):
     """Computes the luminance of frame sequence `seq`.
 
     :param seq: Image sequence, or part of image sequence.
@@ -151,17 +531,293 @@ def luminance_sequence(seq, fov, ref, noise, select=None, processes=_nprocs):
     :param noise: Noise (brightness) level. Typically computed by calling
      `average_cbright()` with a suitable selection of the main sequence.
     :type noise: float
-    :param select: Optional selection of images.
-    :type select: tuple
+    :param select: Optional selection of images (rectangle, `RegionMask`, mask
+     or weight image), or list or dict of selections. For multiple regions
+     `fov`, `ref` and `noise` may be given per region as arrays (or as dicts
+     with the keys of `select`).
+    :type select: tuple, RegionMask, ndarray, list or dict
     :param processes: Number of processes to use (default is number of host
      CPUs).
     :type processes: int
+    :param cache: Optional brightness cache. With a cache hit, changing only
+     `fov`, `ref` or `noise` does not require reading the frames again.
+    :type cache: cache.BrightnessCache
     :return: Luminance (in square meters) for each frame in given input
-     sequence.
+     sequence; of shape (frames, regions) for multiple selections.
+    :rtype: ndarray
+    """
+    fov, ref, noise = (_per_region(v, select) for v in (fov, ref, noise))
+    return fov * (cumul_bright_sequence(seq, select, processes, cache=cache)
+                  - noise) / (ref - noise)
+
+
+class LuminancePipeline:
+    """Computes brightness, noise level and luminance of a sequence in a
+    single pass over its frames. The usual set up (`average_cbright()` for
+    the noise level, again with `uncert=True` for its uncertainty, then
+    `luminance_sequence()`) reads the pre-event frames up to three times;
+    here every frame is read once, and the noise level is taken from the
+    brightness of the frames in the noise window.
+
+    .. attribute:: noise_frames
+
+        Frames of the sequence that show the background before the event:
+        the number of frames from the start, or a slice.
+
+    .. attribute:: select
+
+        Selection(s) as for `cumul_bright_sequence()`.
+
+    .. attribute:: fov
+
+        Field of view (square meters). Per region as array or dict for
+        multiple selections, as are `sfov`, `ref` and `sref`.
+
+    .. attribute:: sfov
+
+        Standard deviation of `fov`.
+
+    .. attribute:: ref
+
+        Reference (melt) brightness.
+
+    .. attribute:: sref
+
+        Standard deviation of `ref`.
+
+    .. attribute:: step
+
+        If set, frames are sampled adaptively with this coarse spacing (see
+        `adaptive_cbright_sequence()`), with brightness tolerance `tol`.
+
+    .. attribute:: checkpoint
+
+        Optional folder in which partial brightness arrays are kept, so an
+        interrupted run resumes where it stopped.
+    """
+    def __init__(self, noise_frames, fov, ref, select=None, sfov=0.,
+                 sref=0., processes=_nprocs, cache=None, step=None,
+                 tol=None, checkpoint=None):
+        """See above.
+
+        :param noise_frames:
+        :param fov:
+        :param ref:
+        :param select:
+        :param sfov:
+        :param sref:
+        :param processes: Number of worker processes.
+        :param cache: Optional brightness cache.
+        :param step:
+        :param tol:
+        :param checkpoint: Folder for partial results of interrupted runs
+         (see `cumul_bright_sequence()`). Not used with adaptive sampling.
+        """
+        self.noise_frames = noise_frames
+        self.select = _prepare_select(select)
+        self.fov, self.sfov = fov, sfov
+        self.ref, self.sref = ref, sref
+        self.processes = processes
+        self.cache = cache
+        self.step, self.tol = step, tol
+        self.checkpoint = checkpoint
+
+    def _window(self):
+        if isinstance(self.noise_frames, slice):
+            return self.noise_frames
+        return slice(0, int(self.noise_frames))
+
+    def run(self, seq, executor=None, progress=None):
+        """Processes `seq`.
+
+        :param seq: Image sequence. The noise window refers to its frames.
+        :type seq: Slicerator
+        :param executor: Worker pool to use instead of the shared one.
+        :type executor: parallel.SequenceExecutor
+        :param progress: Progress callback (see `cumul_bright_sequence()`).
+        :type progress: callable
+        :return: Dict with brightness 'B', noise level 'B0' and its standard
+         deviation 'sB0', luminance 'L' and its standard deviation 'sL'.
+         Arrays have one column per region for multiple selections. With
+         adaptive sampling also 'measured', which marks the frames that were
+         read.
+        :rtype: dict
+        """
+        if self.step is None:
+            return self.evaluate(cumul_bright_sequence(
+                seq, self.select, self.processes, cache=self.cache,
+                executor=executor, progress=progress,
+                checkpoint=self.checkpoint))
+        bright, measured = adaptive_cbright_sequence(
+            seq, self.select, self.step, self.tol, self._window(),
+            processes=self.processes, cache=self.cache, executor=executor)
+        ret = self.evaluate(bright)
+        ret['measured'] = measured
+        return ret
+
+    def evaluate(self, bright):
+        """Noise level and luminance of brightness `bright` that has already
+        been computed, e.g. merged from shards (see `shard.merge_shards()`).
+
+        :param bright: Brightness B(t) of the whole sequence, with one column
+         per region for multiple selections.
+        :type bright: ndarray
+        :return: Dict as returned by `run()`, without 'measured'.
+        :rtype: dict
+        """
+        window = bright[self._window()]
+        if len(window) == 0:
+            raise ValueError("Noise window %s contains no frames of a "
+                             "sequence with %d frames"
+                             % (self.noise_frames, len(bright)))
+        b0, sb0 = window.mean(axis=0), window.std(axis=0)
+        fov, sfov, ref, sref = (_per_region(v, self.select) for v in
+                                (self.fov, self.sfov, self.ref, self.sref))
+        lum = fov * (bright - b0) / (ref - b0)
+        return {'B': bright, 'B0': b0, 'sB0': sb0, 'L': lum,
+                'sL': sigma_luminance(lum, ref, sref, b0, sb0, fov, sfov)}
+
+
+def tile_integral(frame, tile):
+    """Integral image of the brightness of `frame` on a grid of
+    `tile` x `tile` pixel tiles. Tiles at the lower and right edges may be
+    smaller if the frame size is not a multiple of `tile`.
+
+    :param frame: Image frame.
+    :type frame: 2D `ndarray`
+    :param tile: Tile size in pixels.
+    :type tile: int
+    :return: Array of shape (tiles0 + 1, tiles1 + 1). Element [i, j] is the
+     brightness of all tiles above row i and left of column j.
     :rtype: ndarray
     """
-    return fov * (cumul_bright_sequence(seq, select, processes) - noise) \
-        / (ref - noise)
+    h, w = frame.shape[:2]
+    sums = _np.add.reduceat(
+        _np.add.reduceat(frame, _np.arange(0, h, tile), axis=0,
+                         dtype=_np.float64),
+        _np.arange(0, w, tile), axis=1)
+    ret = _np.zeros((sums.shape[0] + 1, sums.shape[1] + 1),
+                    dtype=_np.float64)
+    _np.cumsum(_np.cumsum(sums, axis=0), axis=1, out=ret[1:, 1:])
+    return ret
+
+
+class TileCube:
+    """Tile resolution integral images of every frame of a sequence. Once
+    built (one pass over the frames), the brightness B(t) of any tile aligned
+    rectangle is obtained from four values per frame, without reading the
+    frames again. This makes trying out different regions of interest cheap.
+
+    Memory use is 8 * frames * (tiles0 + 1) * (tiles1 + 1) bytes.
+
+    .. attribute:: integral
+
+        Array of shape (frames, tiles0 + 1, tiles1 + 1), see
+        `tile_integral()`.
+
+    .. attribute:: tile
+
+        Tile size in pixels.
+
+    .. attribute:: frame_shape
+
+        Frame shape in pixels.
+    """
+    def __init__(self, integral, tile, frame_shape):
+        """See above.
+
+        :param integral:
+        :param tile:
+        :param frame_shape:
+        """
+        self.integral = integral
+        self.tile = tile
+        self.frame_shape = tuple(frame_shape)
+
+    @classmethod
+    def from_sequence(cls, seq, tile=16, processes=_nprocs, executor=None):
+        """Builds the cube from an image sequence.
+
+        :param seq: Image sequence.
+        :type seq: Slicerator
+        :param tile: Tile size in pixels.
+        :type tile: int
+        :param processes: Number of processes to use.
+        :type processes: int
+        :param executor: Worker pool to use instead of the shared one.
+        :type executor: parallel.SequenceExecutor
+        :rtype: TileCube
+        """
+        fshape = tuple(_np.shape(seq[0])[:2])
+        shape = tuple(-(-n // tile) + 1 for n in fshape)
+        if executor is None:
+            executor = _par.get_executor(processes)
+        integral = executor.map_frames(
+            seq, _partial(tile_integral, tile=tile), shape=shape,
+            dtype=_np.float64)
+        return cls(integral, tile, fshape)
+
+    def save(self, fname):
+        """Stores the cube in a `.npz` file."""
+        _np.savez(fname, integral=self.integral, tile=self.tile,
+                  frame_shape=self.frame_shape)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a cube stored with `save()`."""
+        with _np.load(fname) as f:
+            return cls(f['integral'], int(f['tile']),
+                       tuple(int(n) for n in f['frame_shape']))
+
+    def __len__(self):
+        return len(self.integral)
+
+    def _tile_index(self, pos, axis, snap, upper):
+        n = self.frame_shape[axis]
+        pos = min(max(pos, 0), n)
+        if pos == n:
+            return self.integral.shape[axis + 1] - 1
+        q, r = divmod(pos, self.tile)
+        if r:
+            if not snap:
+                raise ValueError(
+                    "Selection boundary %d is not aligned to the %d pixel "
+                    "tile grid (use snap=True to round it to the grid)."
+                    % (pos, self.tile))
+            q += upper
+        return q
+
+    def cumul_bright(self, select=None, snap=False):
+        """Brightness B(t) of a tile aligned region for all frames.
+
+        :param select: ((start0, end0), (start1, end1)) in pixels, or a list or
+         dict of selections as for `cumul_bright_sequence()`. `None` is the
+         whole frame.
+        :type select: tuple, list or dict
+        :param snap: Round boundaries that are not tile aligned outwards to
+         the grid, instead of raising a `ValueError`.
+        :type snap: bool
+        :return: Brightness array B(t); of shape (frames, regions) for
+         multiple selections.
+        :rtype: ndarray
+        """
+        sels, multi = _selections(select)
+        ret = _np.empty((len(self), len(sels)), dtype=_np.float64)
+        for k, sel in enumerate(sels):
+            if sel is None:
+                sel = ((0, self.frame_shape[0]), (0, self.frame_shape[1]))
+            if isinstance(sel, (RegionMask, _np.ndarray)):
+                raise TypeError("TileCube only supports rectangular "
+                                "selections.")
+            ((start0, end0), (start1, end1)) = sel
+            i0 = self._tile_index(start0, 0, snap, False)
+            i1 = self._tile_index(end0, 0, snap, True)
+            j0 = self._tile_index(start1, 1, snap, False)
+            j1 = self._tile_index(end1, 1, snap, True)
+            ig = self.integral
+            ret[:, k] = ig[:, i1, j1] - ig[:, i0, j1] - ig[:, i1, j0] \
+                + ig[:, i0, j0]
+        return ret if multi else ret[:, 0]
 
 
 def sigma_luminance(lum, ref, sref, noise, snoise, fov, sfov):
@@ -250,6 +906,105 @@ def dldot(t, lum, threshold=None, invalid=_np.nan):
     return ret
 
 
+def noise_sigma(signal):
+    """Robust estimate of the standard deviation of white noise on a smooth
+    signal, from the median absolute deviation of its second differences.
+
+    :param signal: Signal samples (e.g. luminance).
+    :type signal: ndarray
+    :rtype: float
+    """
+    d = _np.diff(signal, 2)
+    return _np.median(_np.abs(d - _np.median(d))) / (0.6745 * _np.sqrt(6.))
+
+
+def _spline_window(win, s, k):
+    """Smoothing spline fit of one (t, signal) window; returns values and
+    first derivative at the window's sample times. With `s` `None` the
+    smoothing factor is m sigma^2 (1 + 3 sqrt(2 / m)) for m samples, i.e. a
+    few standard deviations of the residual sum above its expected value;
+    FITPACK tends to add many spurious knots when `s` is slightly too small.
+    """
+    t, y = win
+    if s is None:
+        m = len(y)
+        s = m * noise_sigma(y) ** 2 * (1. + 3. * _np.sqrt(2. / m))
+    spl = _UnivariateSpline(t, y, s=s, k=k)
+    return _np.array([spl(t), spl.derivative(n=1)(t)])
+
+
+def smooth_dldot(t, lum, s=None, window=8192, overlap=512, k=3,
+                 threshold=None, invalid=_np.nan, processes=_nprocs):
+    """Smoothed luminance, its time derivative and the associated speed
+    v = Ldot / (2 sqrt(L)), in one call. This replaces fitting a
+    `UnivariateSpline` by hand and calling `dldot()`.
+
+    Smoothing splines are fitted to windows of `window` samples that overlap
+    by at least `overlap` samples, on the worker pool, and blended linearly
+    across the overlaps. Unless given, the smoothing factor of each window is
+    chosen from the noise level within that window (see `noise_sigma()`).
+
+    :param t: Time array (strictly increasing).
+    :type t: ndarray
+    :param lum: Raw luminance.
+    :type lum: ndarray
+    :param s: Smoothing factor for the whole series, as for
+     `UnivariateSpline`. Each window uses its share of it. Default is
+     automatic selection.
+    :type s: float
+    :param window: Samples per spline window.
+    :type window: int
+    :param overlap: Minimum overlap of neighbouring windows, from 0 (no
+     blending) to `window` - 1.
+    :type overlap: int
+    :param k: Spline degree.
+    :type k: int
+    :param threshold: Noise threshold value. At luminosities below this value
+     v is set to `invalid`. Non-positive luminosities are always invalid.
+    :type threshold: float
+    :param invalid: Number to use to signify an invalid value (NaN)
+    :param processes: Number of processes to use.
+    :type processes: int
+    :return: (L, Ldot, v)
+    :rtype: tuple
+    :raises ValueError: if `overlap` is not in 0 to `window` - 1.
+    """
+    if not 0 <= overlap < window:
+        raise ValueError("overlap must be at least 0 and less than window "
+                         "(%d), not %d." % (window, overlap))
+    t = _np.asarray(t, dtype=_np.float64)
+    lum = _np.asarray(lum, dtype=_np.float64)
+    n = len(lum)
+    if n <= window:
+        lsm, ldt = _spline_window((t, lum), s, k)
+    else:
+        step = window - overlap
+        starts = list(range(0, n - window, step)) + [n - window]
+        fits = _par.get_executor(processes).map_frames(
+            [(t[a:a + window], lum[a:a + window]) for a in starts],
+            _partial(_spline_window, s=None if s is None else s * window / n,
+                     k=k),
+            shape=(2, window))
+        acc = _np.zeros((2, n))
+        wsum = _np.zeros(n)
+        ramp = _np.linspace(0., 1., overlap + 2)[1:-1]
+        for i, a in enumerate(starts):
+            w = _np.ones(window)
+            if i > 0 and overlap:
+                w[:overlap] = ramp
+            if i < len(starts) - 1 and overlap:
+                w[-overlap:] = ramp[::-1]
+            acc[:, a:a + window] += w * fits[i]
+            wsum[a:a + window] += w
+        lsm, ldt = acc / wsum
+    v = _np.full(n, invalid, dtype=_np.float64)
+    idx = lsm > 0.
+    if threshold is not None:
+        idx &= lsm >= threshold
+    v[idx] = ldt[idx] / (2 * _np.sqrt(lsm[idx]))
+    return lsm, ldt, v
+
+
 def sigma_dldot(ldot, sldot, lum, slum, lmin: float):
     """Standard deviation of dldot.
     All parameters except `lmin` should be given either as ndarray, or as
@@ -287,6 +1042,249 @@ def sigma_dldot(ldot, sldot, lum, slum, lmin: float):
     return ret
 
 
+_derived = ('L', 'sL', 'Ldot', 'sLdot', 'v', 'sv')
+
+
+def derived_quantities(bright, noise, snoise, fov, sfov, ref, sref, srate,
+                       ssrate=0., ldot=None, lmin=1e-4, threshold=None,
+                       invalid=_np.nan, out=None):
+    """Luminance L, its time derivative Ldot, the speed v = Ldot / (2 sqrt(L))
+    and their standard deviations in one pass. The results agree with
+    `luminance_sequence()`, `sigma_luminance()`, `sigma_ldot()` and
+    `sigma_dldot()`, but intermediate values (1 / (ref - B0), sqrt(L), masks)
+    are computed once, and all work is done in place in the output arrays
+    and two scratch arrays. With `out` buffers that are reused, e.g. for the
+    runs of a batch report, no large arrays are allocated at all.
+
+    Time runs along the last axis, so `bright` can hold a single series, or a
+    (runs, frames) array of several runs. Calibration values are scalars, or
+    have one value per run (shape (runs,)).
+
+    :param bright: Brightness B(t).
+    :type bright: ndarray
+    :param noise: Background noise brightness (B0).
+    :type noise: float or ndarray
+    :param snoise: Standard deviation of `noise`.
+    :type snoise: float or ndarray
+    :param fov: Field of view.
+    :type fov: float or ndarray
+    :param sfov: Standard deviation of `fov`.
+    :type sfov: float or ndarray
+    :param ref: Reference (melt) brightness.
+    :type ref: float or ndarray
+    :param sref: Standard deviation of `ref`.
+    :type sref: float or ndarray
+    :param srate: Sampling rate.
+    :type srate: float
+    :param ssrate: Standard deviation of `srate`.
+    :type ssrate: float
+    :param ldot: Time derivative of L, e.g. from `smooth_dldot()`. Default is
+     the central difference of L (one-sided at the ends).
+    :type ldot: ndarray
+    :param lmin: Minimum luminance for the uncertainties of Ldot and v, which
+     are NaN below it (see `sigma_ldot()` and `sigma_dldot()`).
+    :type lmin: float
+    :param threshold: Noise threshold value. At luminosities below this value
+     v is set to `invalid`. Non-positive luminosities are always invalid.
+    :type threshold: float
+    :param invalid: Number to use to signify an invalid value of v.
+    :param out: Dict of arrays (float64, shape of `bright`) to store the
+     results in, with any of the keys of the returned dict. Missing ones are
+     allocated.
+    :type out: dict
+    :return: Dict with 'L', 'sL', 'Ldot', 'sLdot', 'v' and 'sv'.
+    :rtype: dict
+    """
+    bright = _np.asarray(bright, dtype=_np.float64)
+    shape = bright.shape
+
+    def per_run(p):
+        p = _np.asarray(p, dtype=_np.float64)
+        return p[..., None] if 0 < p.ndim == bright.ndim - 1 else p
+
+    noise, snoise, fov, sfov, ref, sref = (
+        per_run(p) for p in (noise, snoise, fov, sfov, ref, sref))
+    ret = {} if out is None else dict(out)
+    for k in _derived:
+        if k not in ret:
+            ret[k] = _np.empty(shape)
+    lum, slum, ld, sld, v, sv = (ret[k] for k in _derived)
+    tmp, root = _np.empty(shape), _np.empty(shape)
+    mask = _np.empty(shape, dtype=_np.bool_)
+    inv = 1. / (ref - noise)
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        _np.subtract(bright, noise, out=lum)
+        lum *= fov * inv
+        # sL^2 = (L sref / (ref - B0))^2 + ((L - fov) sB0 / (ref - B0))^2
+        #        + (L sfov / fov)^2
+        _np.multiply(lum, inv * sref, out=slum)
+        _np.square(slum, out=slum)
+        _np.subtract(lum, fov, out=tmp)
+        tmp *= inv * snoise
+        _np.square(tmp, out=tmp)
+        slum += tmp
+        _np.multiply(lum, sfov / fov, out=tmp)
+        _np.square(tmp, out=tmp)
+        slum += tmp
+        _np.sqrt(slum, out=slum)
+        if ldot is None:
+            if shape[-1] < 2:
+                raise ValueError("Ldot needs at least two frames.")
+            _np.subtract(lum[..., 2:], lum[..., :-2], out=ld[..., 1:-1])
+            ld[..., 1:-1] *= .5
+            _np.subtract(lum[..., 1:2], lum[..., :1], out=ld[..., :1])
+            _np.subtract(lum[..., -1:], lum[..., -2:-1], out=ld[..., -1:])
+            ld *= srate
+        elif ldot is not ld:
+            ld[...] = ldot
+        _np.sqrt(lum, out=root)
+        # v = Ldot / (2 sqrt(L))
+        _np.divide(ld, root, out=v)
+        v *= .5
+        _np.less_equal(lum, 0., out=mask)
+        if threshold is not None:
+            mask |= lum < threshold
+        _np.copyto(v, invalid, where=mask)
+        # sLdot^2 = (Ldot sL / L)^2 + (Ldot ssrate / srate)^2
+        _np.divide(slum, lum, out=tmp)
+        tmp *= ld
+        _np.square(tmp, out=tmp)
+        _np.multiply(ld, ssrate / srate, out=sld)
+        _np.square(sld, out=sld)
+        sld += tmp
+        _np.sqrt(sld, out=sld)
+        _np.less(lum, lmin, out=mask)
+        _np.copyto(sld, _np.nan, where=mask)
+        # sv^2 = (sLdot / (2 L^0.5))^2 + (Ldot sL / (4 L^1.5))^2
+        _np.divide(sld, root, out=tmp)
+        tmp *= .5
+        _np.square(tmp, out=tmp)
+        _np.multiply(ld, slum, out=sv)
+        sv /= lum
+        sv /= root
+        sv *= .25
+        _np.square(sv, out=sv)
+        sv += tmp
+        _np.sqrt(sv, out=sv)
+        _np.less_equal(lum, lmin, out=mask)
+        _np.copyto(sv, _np.nan, where=mask)
+    return ret
+
+
+def _draw(param, samples, rng):
+    """Samples of a calibration parameter, given as fixed value, (mean,
+    sigma) tuple of a normal distribution, array of samples, or an object with
+    an `rvs()` method (e.g. a frozen `scipy.stats` distribution)."""
+    if hasattr(param, 'rvs'):
+        return _np.asarray(param.rvs(size=samples, random_state=rng),
+                           dtype=_np.float64)
+    if isinstance(param, tuple):
+        mean, sigma = param
+        return rng.normal(mean, sigma, samples)
+    ret = _np.asarray(param, dtype=_np.float64)
+    if ret.ndim == 0:
+        return _np.full(samples, ret)
+    if ret.shape != (samples,):
+        raise ValueError("Got %d parameter samples, expected %d."
+                         % (len(ret), samples))
+    return ret
+
+
+def _percentiles(a, q):
+    """Percentiles `q` of `a` along axis 0 (linear interpolation, nan values
+    ignored). Sorts `a` in place, which is cheaper than one partition per
+    percentile."""
+    a.sort(axis=0)
+    cnt = a.shape[0] - _np.isnan(a).sum(axis=0)
+    pos = _np.asarray(q, dtype=_np.float64)[:, None] / 100. * (cnt - 1)
+    lo = _np.floor(pos).astype(_np.intp)
+    hi = _np.minimum(lo + 1, cnt - 1)
+    lo, hi = _np.maximum(lo, 0), _np.maximum(hi, 0)
+    cols = _np.arange(a.shape[1])
+    ret = a[lo, cols] + (pos - lo) * (a[hi, cols] - a[lo, cols])
+    ret[:, cnt == 0] = _np.nan
+    return ret
+
+
+def luminance_ensemble(bright, fov, ref, noise, srate, samples=1000,
+                       percentiles=(2.5, 16., 50., 84., 97.5), dbright=None,
+                       lmin=1e-4, seed=None, max_bytes=2 ** 27):
+    """Monte Carlo propagation of calibration uncertainties. Luminance L,
+    its time derivative Ldot and the speed v = Ldot / (2 sqrt(L)) are
+    evaluated for many samples of the calibration parameters at once, and
+    summarized by percentile bands, mean and standard deviation per frame.
+    The work is done on (samples, frames) blocks with at most about
+    `max_bytes` per temporary array.
+
+    The calibration parameters `fov`, `ref`, `noise` and `srate` can each be
+    given as fixed value, as (mean, sigma) tuple of a normal distribution, as
+    array of `samples` values, or as distribution with an `rvs()` method
+    (e.g. `scipy.stats.norm(mean, sigma)`).
+
+    :param bright: Brightness B(t), as returned by `cumul_bright_sequence()`.
+    :type bright: ndarray
+    :param fov: Field of view.
+    :param ref: Reference (melt) brightness.
+    :param noise: Background noise brightness (B0).
+    :param srate: Sampling rate.
+    :param samples: Number of parameter samples.
+    :type samples: int
+    :param percentiles: Percentiles to compute.
+    :type percentiles: tuple
+    :param dbright: Derivative of B(t) with respect to the frame number.
+     Default is `numpy.gradient(bright)`. Passing the derivative of a smoothed
+     B(t) gives smoother Ldot and v.
+    :type dbright: ndarray
+    :param lmin: Luminance below which v is invalid (nan) for a sample.
+    :type lmin: float
+    :param seed: Seed of the random number generator.
+    :type seed: int
+    :param max_bytes: Approximate size limit of the temporary arrays.
+    :type max_bytes: int
+    :return: dict with the percentile bands of 'L', 'Ldot' and 'v' (arrays of
+     shape (len(percentiles), frames)), their means and standard deviations
+     ('L_mean', 'L_std', ...), and the 'percentiles'.
+    :rtype: dict
+    """
+    rng = _np.random.RandomState(seed)
+    bright = _np.asarray(bright, dtype=_np.float64)
+    if dbright is None:
+        dbright = _np.gradient(bright)
+    fov, ref, noise, srate = (_draw(p, samples, rng)
+                              for p in (fov, ref, noise, srate))
+    scale = (fov / (ref - noise))[:, None]
+    rscale = scale * srate[:, None]
+    noise = noise[:, None]
+    n = len(bright)
+    ret = {'percentiles': _np.asarray(percentiles)}
+    for q in ('L', 'Ldot', 'v'):
+        ret[q] = _np.empty((len(percentiles), n))
+        ret[q + '_mean'] = _np.empty(n)
+        ret[q + '_std'] = _np.empty(n)
+    block = max(1, max_bytes // (8 * samples))
+    for start in range(0, n, block):
+        sl = slice(start, min(start + block, n))
+        lum = scale * (bright[sl] - noise)
+        ldot = rscale * dbright[sl]
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            v = ldot / (2 * _np.sqrt(lum))
+        v[lum < lmin] = _np.nan
+        for q, a in (('L', lum), ('Ldot', ldot)):
+            ret[q + '_mean'][sl] = a.mean(axis=0)
+            ret[q + '_std'][sl] = a.std(axis=0)
+            ret[q][:, sl] = _percentiles(a, percentiles)
+        with _warnings.catch_warnings():
+            # frames where all samples are below `lmin` give nan silently
+            _warnings.simplefilter('ignore', RuntimeWarning)
+            ret['v_mean'][sl] = _np.nanmean(v, axis=0)
+            ret['v_std'][sl] = _np.nanstd(v, axis=0)
+        ret['v'][:, sl] = _percentiles(v, percentiles)
+    return ret
+
+
+_sos_cache = {}
+
+
 class FilterProfile:
     """A little profile object to store camera specific filter profiles.
 
@@ -320,6 +1318,28 @@ class FilterProfile:
         self.freqs = filterfreq
         self.filterwidth = filterwidth
 
+    def sos(self):
+        """Second order sections of the cascade of all band-stop filters in
+        this profile. The cascade is designed once and cached by sampling
+        rate, frequencies and filter width.
+
+        :return: Array of shape (sections, 6), see `scipy.signal.sosfilt()`.
+        :rtype: ndarray
+        """
+        key = (float(self.srate), tuple(float(f) for f in self.freqs),
+               float(self.filterwidth))
+        ret = _sos_cache.get(key)
+        if ret is None:
+            fw, r = self.filterwidth, self.srate
+            ret = _np.vstack([
+                _sig.bessel(
+                    2, _np.array([fr - fw, fr + fw]) / (0.5 * r),
+                    btype='bandstop', analog=False, output='sos')
+                for fr in self.freqs
+            ])
+            _sos_cache[key] = ret
+        return ret
+
 
 prof_casiof1 = FilterProfile(
     'Casio F1', srate=300.,
@@ -327,26 +1347,152 @@ prof_casiof1 = FilterProfile(
 )
 
 
-def filter_lum(lum, profile):
+def _padlen(sos, n):
+    """Default `sosfiltfilt` padding length for `sos`, limited to signals of
+    length `n`."""
+    padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(),
+                                         (sos[:, 5] == 0).sum()))
+    return min(padlen, n - 1)
+
+
+def _initial_state(sos, x0):
+    """Filter state for `sosfilt` as if the signal had been constant at
+    `x0` (one sample, possibly of several signals) before."""
+    zi = _sig.sosfilt_zi(sos)
+    return zi.reshape(zi.shape + (1,) * _np.ndim(x0)) * x0
+
+
+def filter_lum(lum, profile, causal=False):
     """Filters a luminance (or any other) signal according to the given filter
-    profile.
+    profile. The whole band-stop cascade is applied in one zero-phase pass
+    (forward and backward) in second order sections form.
 
-    :param lum: 'raw' signal to be filtered.
+    :param lum: 'raw' signal to be filtered. A 2D array of shape
+     (frames, signals) filters all signals in one call.
     :type lum: ndarray
     :param profile: Filter profile.
     :type profile: FilterProfile
+    :param causal: Apply the cascade once, forward only (with the initial
+     state of a signal that was constant before its first sample). This is
+     what `StreamingFilter` computes chunk by chunk.
+    :type causal: bool
     :return: Filtered signal.
     :rtype: ndarray
     """
-    fw = profile.filterwidth
-    r = profile.srate
-    pars = [
-        _sig.bessel(
-            2, _np.array([fr - fw, fr + fw]) / (0.5 * r),
-            btype='bandstop', analog=False)
-        for fr in profile.freqs
-    ]
-    filtered = lum.copy()
-    for bb, ab in pars:
-        filtered = _sig.filtfilt(bb, ab, filtered, axis=0)
-    return filtered
+    sos = profile.sos()
+    if causal:
+        return _sig.sosfilt(sos, lum, axis=0,
+                            zi=_initial_state(sos, lum[0]))[0]
+    return _sig.sosfiltfilt(sos, lum, axis=0,
+                            padlen=_padlen(sos, lum.shape[0]))
+
+
+def _settle_length(sos, tol=1e-6, nmax=2 ** 16):
+    """Number of samples after which the impulse response of `sos` has
+    decayed below `tol` times its maximum."""
+    imp = _np.zeros(nmax)
+    imp[0] = 1.
+    h = _np.abs(_sig.sosfilt(sos, imp))
+    return int(_np.flatnonzero(h > tol * h.max())[-1]) + 1
+
+
+class StreamingFilter:
+    """Filters a signal that arrives in chunks with the band-stop cascade of a
+    `FilterProfile`, e.g. while frames are still being processed, or for
+    recordings too long to filter in memory at once.
+
+    In the default causal mode the filter state is carried from one chunk to
+    the next, so the concatenated output of `process()` equals
+    `filter_lum(signal, profile, causal=True)` for the concatenated signal.
+
+    With `zero_phase` the signal is filtered forward and backward in
+    overlapping blocks of `block` samples, with `overlap` samples of context
+    on either side that are discarded. Output lags the input by up to
+    `block + overlap` samples, and `flush()` returns the rest at the end. The
+    result matches `filter_lum(signal, profile)` to within the decay of the
+    impulse response over `overlap` samples.
+
+    .. attribute:: sos
+
+        Second order sections of the filter, see `FilterProfile.sos()`.
+    """
+    def __init__(self, profile, zero_phase=False, block=8192, overlap=None):
+        """See above.
+
+        :param profile: Filter profile.
+        :param zero_phase: Use block-wise zero-phase filtering.
+        :param block: Number of samples per block in zero-phase mode.
+        :param overlap: Context samples on either side of a block. Default is
+         the length after which the impulse response has decayed to 1e-6 of
+         its maximum.
+        """
+        self.sos = profile.sos()
+        self.zero_phase = zero_phase
+        self.block = block
+        self.overlap = _settle_length(self.sos) if overlap is None \
+            else overlap
+        self.reset()
+
+    def reset(self):
+        """Starts over with a new signal."""
+        self._zi = None
+        self._hist = None
+        self._pending = None
+
+    def process(self, chunk):
+        """Filters the next chunk of the signal.
+
+        :param chunk: Next samples, along axis 0.
+        :type chunk: ndarray
+        :return: Filtered samples; in zero-phase mode these are the samples
+         that are complete so far, which may be none.
+        :rtype: ndarray
+        """
+        chunk = _np.asarray(chunk, dtype=_np.float64)
+        if not self.zero_phase:
+            if len(chunk) == 0:
+                return chunk.copy()
+            if self._zi is None:
+                self._zi = _initial_state(self.sos, chunk[0])
+            ret, self._zi = _sig.sosfilt(self.sos, chunk, axis=0,
+                                         zi=self._zi)
+            return ret
+        if self._pending is None:
+            self._hist = chunk[:0]
+            self._pending = chunk
+        else:
+            self._pending = _np.concatenate((self._pending, chunk))
+        out = []
+        while len(self._pending) >= self.block + self.overlap:
+            seg = _np.concatenate(
+                (self._hist, self._pending[:self.block + self.overlap]))
+            nh = len(self._hist)
+            out.append(_sig.sosfiltfilt(
+                self.sos, seg, axis=0, padlen=_padlen(self.sos, len(seg))
+            )[nh:nh + self.block])
+            hist = _np.concatenate((self._hist, self._pending[:self.block]))
+            self._hist = hist[max(len(hist) - self.overlap, 0):]
+            self._pending = self._pending[self.block:]
+        if not out:
+            return chunk[:0].copy()
+        return _np.concatenate(out)
+
+    def flush(self):
+        """Returns the remaining filtered samples in zero-phase mode, and
+        resets the filter.
+
+        :rtype: ndarray
+        """
+        if not self.zero_phase or self._pending is None:
+            self.reset()
+            return _np.empty(0)
+        if len(self._pending) == 0:
+            ret = self._pending.copy()
+            self.reset()
+            return ret
+        seg = _np.concatenate((self._hist, self._pending))
+        nh = len(self._hist)
+        ret = _sig.sosfiltfilt(self.sos, seg, axis=0,
+                               padlen=_padlen(self.sos, len(seg)))[nh:]
+        self.reset()
+        return ret
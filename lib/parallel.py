@@ -0,0 +1,683 @@
+"""Worker pool to evaluate per-frame functions over image sequences."""
+import time
+import atexit
+import pickle
+import threading
+import traceback
+import queue as _queue
+import multiprocessing as _mp
+from multiprocessing import shared_memory as _shm
+import numpy as _np
+from . import load as _load
+
+_nprocs = _mp.cpu_count()
+
+
+class WorkerError(RuntimeError):
+    """Raised when a worker process fails or dies while processing part of a
+    sequence."""
+    pass
+
+
+class SequenceStats:
+    """Progress and timing of one `SequenceExecutor.map_frames()` call. Stage
+    times of the workers are summed over all workers, so they can exceed the
+    elapsed (wall clock) time.
+
+    .. attribute:: frames
+
+        Number of frames of the sequence.
+
+    .. attribute:: done
+
+        Number of frames processed so far.
+
+    .. attribute:: elapsed
+
+        Wall clock time since the call started, in seconds.
+
+    .. attribute:: stages
+
+        Dict of times spent in the stages 'setup' (sending the job and
+        allocating the result), 'read' (reading and decoding frames),
+        'reduce' (evaluating the per frame function), 'transfer' (delivery of
+        the worker reports) and 'collect' (copying the result).
+
+    .. attribute:: workers
+
+        Dict of per worker dicts with the number of 'frames' and 'chunks'
+        processed, the 'read' and 'reduce' times, and the elapsed time of the
+        'last' report received from that worker.
+
+    .. attribute:: cached
+
+        True if the result was taken from a cache and no frames were read.
+    """
+    def __init__(self, frames):
+        """See above.
+
+        :param frames:
+        """
+        self.frames = frames
+        self.done = 0
+        self.elapsed = 0.
+        self.stages = dict.fromkeys(
+            ('setup', 'read', 'reduce', 'transfer', 'collect'), 0.)
+        self.workers = {}
+        self.cached = False
+        self._t0 = time.perf_counter()
+
+    def _tick(self):
+        self.elapsed = time.perf_counter() - self._t0
+        return self.elapsed
+
+    def _report(self, wid, start, end, times):
+        """Accounts for a chunk reported by worker `wid`."""
+        tread, treduce, sent = times
+        w = self.workers.setdefault(wid, {'frames': 0, 'chunks': 0,
+                                          'read': 0., 'reduce': 0.,
+                                          'last': 0.})
+        w['frames'] += end - start
+        w['chunks'] += 1
+        w['read'] += tread
+        w['reduce'] += treduce
+        w['last'] = self._tick()
+        self.done += end - start
+        self.stages['read'] += tread
+        self.stages['reduce'] += treduce
+        self.stages['transfer'] += max(time.time() - sent, 0.)
+
+    @property
+    def frames_per_s(self):
+        """Overall throughput."""
+        return self.done / self.elapsed if self.elapsed > 0 else 0.
+
+    def worker_rates(self):
+        """Frames per second of every worker, over the elapsed time.
+
+        :rtype: dict
+        """
+        return {wid: w['frames'] / self.elapsed if self.elapsed > 0 else 0.
+                for wid, w in self.workers.items()}
+
+    def as_dict(self):
+        """Plain dict of all numbers, e.g. to be saved as JSON."""
+        rates = self.worker_rates()
+        return {'frames': self.frames, 'done': self.done,
+                'elapsed': self.elapsed, 'frames_per_s': self.frames_per_s,
+                'cached': self.cached, 'stages': dict(self.stages),
+                'workers': {str(k): dict(v, frames_per_s=rates[k])
+                            for k, v in self.workers.items()}}
+
+    def __repr__(self):
+        return ("<SequenceStats %d/%d frames in %.2f s (%.1f frames/s); "
+                "%s>" % (self.done, self.frames, self.elapsed,
+                         self.frames_per_s,
+                         ", ".join("%s %.2f s" % kv
+                                   for kv in self.stages.items())))
+
+
+def _install(jobs, jid, job, name, shape, dtype, timed=False):
+    shm = _shm.SharedMemory(name=name)
+    reader, idx, func = job
+    jobs[jid] = {
+        'reader': reader, 'idx': idx, 'func': func, 'shm': shm,
+        'out': _np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        'timed': timed
+    }
+
+
+def _run_timed(reader, idx, func, out, start, end):
+    """Processes frames `start` to `end` of a job and measures how long
+    reading and reducing them takes."""
+    clock = time.perf_counter
+    tread = treduce = 0.
+    for k in range(start, end):
+        t0 = clock()
+        frame = reader[int(idx[k])]
+        t1 = clock()
+        out[k] = func(frame)
+        t2 = clock()
+        tread += t1 - t0
+        treduce += t2 - t1
+    return tread, treduce, time.time()
+
+
+def _release(job):
+    if 'shm' in job:
+        job['out'] = None
+        job['shm'].close()
+
+
+def _worker(wid, inbox, outbox, job=None):
+    """**Do not call this directly.**
+    Main loop of a worker process. Messages in `inbox` are tuples starting
+    with one of 'job' (install a job), 'chunk' (process frames of a job), 'end'
+    (remove a job) and 'stop'. Processed chunks are reported to `outbox`,
+    for timed jobs together with the time spent reading and reducing.
+
+    :param wid: Worker id.
+    :type wid: int
+    :param inbox: Queue for messages to this worker.
+    :type inbox: multiprocessing.Queue
+    :param outbox: Queue shared by all workers for their reports.
+    :type outbox: multiprocessing.Queue
+    :param job: Optional (jid, (reader, indices, func), name, shape, dtype,
+     timed) tuple of a job to install at start up.
+    :type job: tuple
+    :return: None.
+    """
+    jobs = {}
+    if job is not None:
+        _install(jobs, *job)
+    while True:
+        msg = inbox.get()
+        kind = msg[0]
+        if kind == 'stop':
+            break
+        elif kind == 'job':
+            _, jid, payload, name, shape, dtype, timed = msg
+            try:
+                _install(jobs, jid, pickle.loads(payload), name, shape, dtype,
+                         timed)
+            except Exception:
+                jobs[jid] = {'error': traceback.format_exc()}
+        elif kind == 'end':
+            _release(jobs.pop(msg[1], {}))
+        elif kind == 'chunk':
+            _, jid, start, end = msg
+            job = jobs.get(jid)
+            if job is None:
+                continue
+            if 'error' in job:
+                outbox.put(('error', wid, jid, start, end, job['error']))
+                continue
+            reader, idx, func, out = (
+                job['reader'], job['idx'], job['func'], job['out'])
+            try:
+                if job['timed']:
+                    times = _run_timed(reader, idx, func, out, start, end)
+                else:
+                    times = None
+                    for k in range(start, end):
+                        out[k] = func(reader[int(idx[k])])
+            except Exception:
+                outbox.put(('error', wid, jid, start, end,
+                            traceback.format_exc()))
+            else:
+                outbox.put(('done', wid, jid, start, end, times))
+    for job in jobs.values():
+        _release(job)
+
+
+class SequenceExecutor:
+    """A pool of long-lived worker processes that apply a function to every
+    frame of an image sequence. The pool can be reused for any number of
+    sequences. Frames are handed out in small chunks on demand, so slow frames
+    do not hold up the other workers, and results are written directly into a
+    shared memory array.
+
+    Sequences are sent to the workers as the underlying reader and an index
+    array, so slicing a sequence does not trigger reading any frames in the
+    calling process. Readers and functions that cannot be pickled are
+    processed by temporary workers forked for the call; on platforms that
+    cannot fork (Windows) they raise a `TypeError`.
+
+    .. attribute:: processes
+
+        Number of worker processes.
+
+    .. attribute:: chunksize
+
+        Default number of frames handed to a worker at a time. `None` selects
+        a size based on the sequence length.
+
+    .. attribute:: poll
+
+        Interval (in seconds) at which workers are checked for being alive
+        while waiting for results.
+    """
+    def __init__(self, processes=_nprocs, chunksize=None, poll=1.):
+        """See above.
+
+        :param processes:
+        :param chunksize:
+        :param poll:
+        """
+        self.processes = processes
+        self.chunksize = chunksize
+        self.poll = poll
+        self._ctx = _mp.get_context()
+        self._outbox = self._ctx.Queue()
+        self._workers = [None] * processes
+        self._jid = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+
+    def _spawn(self, wid):
+        inbox = self._ctx.Queue()
+        p = self._ctx.Process(target=_worker, args=(wid, inbox, self._outbox),
+                              daemon=True)
+        p.start()
+        self._workers[wid] = (p, inbox)
+
+    def _ensure_workers(self):
+        if self.closed:
+            raise RuntimeError("Executor has been shut down.")
+        if any(w is not None and not w[0].is_alive() for w in self._workers):
+            self._discard()
+        for wid, w in enumerate(self._workers):
+            if w is None:
+                self._spawn(wid)
+
+    def _discard(self):
+        """Terminates all workers and replaces the report queue. A worker
+        that dies while sending a report can leave the shared queue locked,
+        which would block the remaining workers forever."""
+        for w in self._workers:
+            if w is not None and w[0].is_alive():
+                w[0].terminate()
+        for w in self._workers:
+            if w is not None:
+                w[0].join(timeout=self.poll)
+        self._outbox = self._ctx.Queue()
+        self._workers = [None] * self.processes
+
+    def _chunksize(self, n, chunksize):
+        if chunksize is None:
+            chunksize = self.chunksize
+        if chunksize is None:
+            chunksize = min(64, max(1, n // (8 * self.processes)))
+        return chunksize
+
+    def _dispatch(self, workers, outbox, jid, n, chunksize, stats=None,
+                  progress=None, out=None, on_chunk=None):
+        """Hands out chunks of `chunksize` frames to `workers` until all `n`
+        frames have been processed. Chunk reports are accounted for in
+        `stats`, which is passed to `progress` after each chunk, and the
+        finished part of the result `out` is passed to `on_chunk`."""
+        starts = iter(range(0, n, chunksize))
+        total = (n + chunksize - 1) // chunksize
+        pending = [set() for _ in workers]
+
+        def send(wid):
+            start = next(starts, None)
+            if start is not None:
+                end = min(start + chunksize, n)
+                workers[wid][1].put(('chunk', jid, start, end))
+                pending[wid].add((start, end))
+
+        for _ in range(2):
+            for wid in range(len(workers)):
+                send(wid)
+        done = 0
+        while done < total:
+            try:
+                msg = outbox.get(timeout=self.poll)
+            except _queue.Empty:
+                for wid, (p, _) in enumerate(workers):
+                    if pending[wid] and not p.is_alive():
+                        start, end = min(pending[wid])
+                        raise WorkerError(
+                            "Worker %d (pid %d) died with exit code %s while "
+                            "processing frames %d to %d."
+                            % (wid, p.pid, p.exitcode, start, end))
+                continue
+            kind, wid, mjid, start, end = msg[:5]
+            if mjid != jid:
+                continue
+            if kind == 'error':
+                raise WorkerError(
+                    "Worker %d failed while processing frames %d to %d:\n%s"
+                    % (wid, start, end, msg[5]))
+            pending[wid].discard((start, end))
+            done += 1
+            send(wid)
+            if on_chunk is not None:
+                on_chunk(start, end, out[start:end])
+            if stats is not None:
+                stats._report(wid, start, end, msg[5])
+                if progress is not None:
+                    progress(stats)
+
+    def map_frames(self, seq, func, shape=(), dtype=_np.float64,
+                   chunksize=None, progress=None, stats=False, on_chunk=None):
+        """Evaluates `func` for every frame in `seq`.
+
+        Timing is only measured if `stats` or `progress` is given; otherwise
+        the workers run without any instrumentation.
+
+        Finished chunks can be saved as they arrive with `on_chunk`, e.g. to
+        resume an interrupted computation (see `cache.Checkpoint`).
+
+        :param seq: Image sequence, or part of it.
+        :type seq: Slicerator
+        :param func: Function taking a frame. Must be picklable (e.g. a module
+         level function or a `functools.partial` of one).
+        :type func: callable
+        :param shape: Shape of the value returned by `func`.
+        :type shape: tuple
+        :param dtype: Data type of the result.
+        :type dtype: numpy.dtype
+        :param chunksize: Number of frames handed to a worker at a time.
+        :type chunksize: int
+        :param progress: Function called with the `SequenceStats` of the call
+         after every processed chunk.
+        :type progress: callable
+        :param stats: Also return a `SequenceStats` object.
+        :type stats: bool
+        :param on_chunk: Function called with (start, end, values) for every
+         finished chunk, where `values` are the results for frames `start` to
+         `end`. It must not keep a reference to `values`.
+        :type on_chunk: callable
+        :return: Array of shape (len(seq),) + `shape`; with `stats` the tuple
+         (array, SequenceStats).
+        :rtype: ndarray or tuple
+        :raises WorkerError: if `func` raises or a worker process dies.
+        :raises TypeError: if `func` or the reader cannot be pickled on a
+         platform without `fork`.
+        """
+        n, shape, dtype = len(seq), tuple(shape), _np.dtype(dtype)
+        oshape = (n,) + shape
+        st = SequenceStats(n) if stats or progress is not None else None
+        if n == 0:
+            ret = _np.empty(oshape, dtype=dtype)
+            return (ret, st) if stats else ret
+        reader, idx = _load.sequence_indices(seq)
+        try:
+            payload = pickle.dumps((reader, idx, func),
+                                   pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            if 'fork' not in _mp.get_all_start_methods():
+                raise TypeError(
+                    "The function or image reader cannot be pickled (%s), "
+                    "and this platform cannot fork worker processes that "
+                    "would inherit them. Use a module level function, or "
+                    "the 'threads' backend." % e) from e
+            payload = None
+        chunksize = self._chunksize(n, chunksize)
+        self._jid += 1
+        jid = self._jid
+        nbytes = int(_np.prod(oshape, dtype=_np.int64)) * dtype.itemsize
+        shm = _shm.SharedMemory(create=True, size=max(nbytes, 1))
+        out = _np.ndarray(oshape, dtype=dtype, buffer=shm.buf)
+        try:
+            if payload is not None:
+                self._ensure_workers()
+                workers, outbox = self._workers, self._outbox
+                for _, inbox in workers:
+                    inbox.put(('job', jid, payload, shm.name, oshape, dtype,
+                               st is not None))
+                if st is not None:
+                    st.stages['setup'] = st._tick()
+                try:
+                    self._dispatch(workers, outbox, jid, n, chunksize, st,
+                                   progress, out, on_chunk)
+                finally:
+                    for _, inbox in workers:
+                        inbox.put(('end', jid))
+            else:
+                self._map_forked(reader, idx, func, jid, shm, oshape, dtype,
+                                 n, chunksize, st, progress, out, on_chunk)
+            t = st._tick() if st is not None else 0.
+            ret = out.copy()
+            if st is not None:
+                st.stages['collect'] = st._tick() - t
+                return (ret, st) if stats else ret
+            return ret
+        finally:
+            del out
+            shm.close()
+            shm.unlink()
+
+    def _map_forked(self, reader, idx, func, jid, shm, oshape, dtype, n,
+                    chunksize, stats=None, progress=None, out=None,
+                    on_chunk=None):
+        """Runs a job on temporary forked workers, which inherit `reader` and
+        `func` instead of receiving them pickled."""
+        ctx = _mp.get_context('fork')
+        outbox = ctx.Queue()
+        workers = []
+        job = (jid, (reader, idx, func), shm.name, oshape, dtype,
+               stats is not None)
+        for wid in range(min(self.processes, n)):
+            inbox = ctx.Queue()
+            p = ctx.Process(target=_worker, args=(wid, inbox, outbox, job),
+                            daemon=True)
+            p.start()
+            workers.append((p, inbox))
+        if stats is not None:
+            stats.stages['setup'] = stats._tick()
+        try:
+            self._dispatch(workers, outbox, jid, n, chunksize, stats,
+                           progress, out, on_chunk)
+        finally:
+            for p, inbox in workers:
+                inbox.put(('stop',))
+            for p, _ in workers:
+                p.join(timeout=self.poll)
+                if p.is_alive():
+                    p.terminate()
+
+    def shutdown(self):
+        """Stops all worker processes."""
+        for w in self._workers:
+            if w is not None and w[0].is_alive():
+                w[1].put(('stop',))
+        for w in self._workers:
+            if w is not None:
+                w[0].join(timeout=self.poll)
+                if w[0].is_alive():
+                    w[0].terminate()
+        self._workers = [None] * self.processes
+        self.closed = True
+
+
+def _thread_reader(reader):
+    """Copy of `reader` for use in one thread, so readers with state (e.g. an
+    open decoder pipe) are not shared. Readers that cannot be copied are
+    returned as they are."""
+    try:
+        return pickle.loads(pickle.dumps(reader, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return reader
+
+
+class ThreadExecutor:
+    """Evaluates a function for every frame of an image sequence with threads
+    instead of processes. Reader threads decode frames (image decoding and
+    file access mostly release the GIL) into a bounded read-ahead queue, and
+    the calling thread applies the function to them as they arrive. Nothing
+    is forked and no frames are copied between processes, which makes this
+    backend start faster and use less memory than `SequenceExecutor`, e.g.
+    inside notebooks. Functions that hold the GIL for long do not run in
+    parallel, though.
+
+    Every thread reads from its own copy of the sequence's reader.
+
+    .. attribute:: threads
+
+        Number of reader threads.
+
+    .. attribute:: prefetch
+
+        Maximum number of decoded frames waiting to be processed.
+
+    .. attribute:: chunksize
+
+        Default number of consecutive frames a reader thread takes at a time.
+        `None` selects a size based on the sequence length.
+    """
+    def __init__(self, threads=_nprocs, prefetch=None, chunksize=None):
+        """See above.
+
+        :param threads:
+        :param prefetch: Default is two frames per thread.
+        :param chunksize:
+        """
+        self.threads = threads
+        self.prefetch = 2 * threads if prefetch is None else prefetch
+        self.chunksize = chunksize
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+
+    def _read(self, tid, reader, idx, chunks, frames, stop, timed):
+        """Main loop of a reader thread."""
+        clock = time.perf_counter
+        try:
+            reader = _thread_reader(reader)
+            while not stop.is_set():
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                for k in range(*chunk):
+                    t0 = clock() if timed else 0.
+                    frame = reader[int(idx[k])]
+                    t = (clock() - t0, time.time()) if timed else None
+                    while not stop.is_set():
+                        try:
+                            frames.put((tid, k, frame, t), timeout=.1)
+                            break
+                        except _queue.Full:
+                            pass
+        except Exception:
+            frames.put((tid, None, traceback.format_exc(), None))
+        finally:
+            frames.put((tid, None, None, None))
+
+    def map_frames(self, seq, func, shape=(), dtype=_np.float64,
+                   chunksize=None, progress=None, stats=False, on_chunk=None):
+        """Evaluates `func` for every frame in `seq`. Arguments and return
+        value are the same as for `SequenceExecutor.map_frames()`; `func`
+        need not be picklable. Frames are reported to `stats` one by one,
+        `progress` is called after every `chunksize` frames, and `on_chunk`
+        once all frames of a chunk are done.
+
+        :raises WorkerError: if reading a frame or `func` fails.
+        """
+        if self.closed:
+            raise RuntimeError("Executor has been shut down.")
+        n, shape, dtype = len(seq), tuple(shape), _np.dtype(dtype)
+        out = _np.empty((n,) + shape, dtype=dtype)
+        st = SequenceStats(n) if stats or progress is not None else None
+        if n == 0:
+            return (out, st) if stats else out
+        reader, idx = _load.sequence_indices(seq)
+        if chunksize is None:
+            chunksize = self.chunksize
+        if chunksize is None:
+            chunksize = min(64, max(1, n // (8 * self.threads)))
+        lock = threading.Lock()
+        starts = iter(range(0, n, chunksize))
+
+        def chunks():
+            while True:
+                with lock:
+                    start = next(starts, None)
+                if start is None:
+                    return
+                yield start, min(start + chunksize, n)
+
+        frames = _queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        nthreads = min(self.threads, (n + chunksize - 1) // chunksize)
+        workers = [threading.Thread(
+            target=self._read, args=(tid, reader, idx, chunks(), frames, stop,
+                                     st is not None), daemon=True)
+            for tid in range(nthreads)]
+        for w in workers:
+            w.start()
+        if st is not None:
+            st.stages['setup'] = st._tick()
+        clock = time.perf_counter
+        running, done = nthreads, 0
+        left = {}
+        try:
+            while running:
+                tid, k, frame, t = frames.get()
+                if k is None:
+                    if frame is not None:
+                        raise WorkerError("Reader thread %d failed:\n%s"
+                                          % (tid, frame))
+                    running -= 1
+                    continue
+                t0 = clock()
+                try:
+                    out[k] = func(frame)
+                except Exception:
+                    raise WorkerError("Failed to process frame %d:\n%s"
+                                      % (k, traceback.format_exc()))
+                done += 1
+                if on_chunk is not None:
+                    start = k - k % chunksize
+                    end = min(start + chunksize, n)
+                    left[start] = left.get(start, end - start) - 1
+                    if not left[start]:
+                        del left[start]
+                        on_chunk(start, end, out[start:end])
+                if st is not None:
+                    st._report(tid, k, k + 1, (t[0], clock() - t0, t[1]))
+                    if progress is not None and (done % chunksize == 0
+                                                 or done == n):
+                        progress(st)
+        finally:
+            stop.set()
+            while any(w.is_alive() for w in workers):
+                try:
+                    frames.get(timeout=.1)
+                except _queue.Empty:
+                    pass
+        if st is not None:
+            st._tick()
+            return (out, st) if stats else out
+        return out
+
+    def shutdown(self):
+        """Marks the executor as closed. Reader threads only live during
+        `map_frames()`."""
+        self.closed = True
+
+
+_executors = {}
+
+backends = {'processes': SequenceExecutor, 'threads': ThreadExecutor}
+"""Executor classes by backend name."""
+
+
+def get_executor(processes=_nprocs, backend='processes'):
+    """Returns the shared executor with `processes` workers, and creates it on
+    first use.
+
+    :param processes: Number of worker processes (or threads).
+    :type processes: int
+    :param backend: 'processes' for a `SequenceExecutor`, or 'threads' for a
+     `ThreadExecutor`.
+    :type backend: str
+    :rtype: SequenceExecutor or ThreadExecutor
+    """
+    if backend not in backends:
+        raise ValueError("Unknown backend '%s', use one of %s"
+                         % (backend, sorted(backends)))
+    ex = _executors.get((backend, processes))
+    if ex is None or ex.closed:
+        ex = _executors[(backend, processes)] = \
+            backends[backend](processes)
+    return ex
+
+
+@atexit.register
+def shutdown():
+    """Stops the workers of all shared executors."""
+    for ex in _executors.values():
+        ex.shutdown()
+    _executors.clear()
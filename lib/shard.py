@@ -0,0 +1,260 @@
+"""Splitting the brightness computation of one sequence across processes or
+machines.
+
+A shard computes the brightness of a range of frames of one campaign job (see
+`campaign`) and writes it to a self-describing `.npz` file. Besides the
+brightness 'B' of its frames, the file holds a JSON description 'meta' with
+the job (run, camera, regions of interest, calibration), the frame range, the
+number of frames of the whole sequence, the frame shape and a key of the image
+files the frames were read from (see `cache.sequence_key()`).
+`merge_shards()` checks that the shards belong to the same job and image
+files, that they do not overlap and that together they cover every frame. It
+then assembles B(t) and computes the luminance of the whole sequence.
+
+Shards only exchange files, so a shared file system is all that is needed to
+split a sequence over the nodes of a cluster, or over several processes on
+one machine::
+
+    python -m lib.shard compute campaign.json pr06_casio-f1 --shard 0 4
+    ...
+    python -m lib.shard compute campaign.json pr06_casio-f1 --shard 3 4
+    python -m lib.shard merge results/pr06_casio-f1.npz \\
+        results/pr06_casio-f1.shard-*.npz
+
+The merged file has the same content as the result of the job in a campaign.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as _np
+from . import load as _load
+from . import luminance as _lum
+from . import cache as _cache
+from . import campaign as _campaign
+
+_checked = ('job', 'frames', 'shape', 'sequence', 'video')
+"""Meta data that must agree between the shards of a sequence."""
+
+
+def shard_range(frames, index, count):
+    """Frame range of shard `index` when `frames` frames are split into
+    `count` shards of (nearly) equal length.
+
+    :param frames: Number of frames of the sequence.
+    :type frames: int
+    :param index: Shard number, from 0 to `count` - 1.
+    :type index: int
+    :param count: Number of shards.
+    :type count: int
+    :return: (start, end)
+    :rtype: tuple
+    """
+    if not 0 <= index < count:
+        raise ValueError("Shard %d does not exist, there are %d shards."
+                         % (index, count))
+    return frames * index // count, frames * (index + 1) // count
+
+
+def shard_name(job, start, end):
+    """File name of the shard with frames `start` to `end` of `job`."""
+    return "%s.shard-%d-%d.npz" % (_campaign.job_name(job), start, end)
+
+
+def compute_shard(job, start=0, end=None, shards=None, fname=None,
+                  directory='.', processes=_lum._nprocs, video=False,
+                  cache=None, checkpoint=None):
+    """Computes the brightness of frames `start` to `end` of a job and saves
+    it as a shard file.
+
+    :param job: Job as returned by `campaign.expand_jobs()`.
+    :type job: dict
+    :param start: First frame.
+    :type start: int
+    :param end: End of the frame range (exclusive). Default is the end of
+     the sequence.
+    :type end: int
+    :param shards: (index, count) to compute shard `index` of `count` equal
+     shards (see `shard_range()`) instead of `start` to `end`.
+    :type shards: tuple
+    :param fname: Output file. Default is `shard_name()` in `directory`.
+    :type fname: str
+    :param directory: Folder for the output file.
+    :type directory: str
+    :param processes: Number of worker processes.
+    :type processes: int
+    :param video: Decode video data sets directly (see `load.imgseq()`).
+    :type video: bool
+    :param cache: Optional brightness cache.
+    :type cache: cache.BrightnessCache
+    :param checkpoint: Folder for partial results, see
+     `luminance.cumul_bright_sequence()`.
+    :type checkpoint: str
+    :return: Name of the shard file.
+    :rtype: str
+    """
+    t0 = time.time()
+    seq = _load.imgseq(job['run'], job['cam'], video=video)
+    n = len(seq)
+    if shards is not None:
+        start, end = shard_range(n, *shards)
+    end = n if end is None else min(end, n)
+    if not 0 <= start < end:
+        raise ValueError("No frames in range %d to %d of a sequence with %d "
+                         "frames." % (start, end, n))
+    shape = tuple(_np.shape(seq[0])[:2])
+    pipe, _ = _campaign.job_pipeline(job, shape, processes, cache)
+    bright = _lum.cumul_bright_sequence(
+        seq[start:end], pipe.select, processes, cache=cache,
+        checkpoint=checkpoint)
+    meta = {'job': job, 'start': start, 'end': end, 'frames': n,
+            'shape': list(shape), 'sequence': _cache.sequence_key(seq),
+            'video': bool(video), 'host': socket.gethostname(),
+            'elapsed': time.time() - t0,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if fname is None:
+        os.makedirs(directory, exist_ok=True)
+        fname = os.path.join(directory, shard_name(job, start, end))
+    with open(fname + '.tmp', 'wb') as f:
+        _np.savez(f, B=bright, meta=_np.array(json.dumps(meta)))
+    os.replace(fname + '.tmp', fname)
+    return fname
+
+
+def read_shard(fname):
+    """Reads a shard file.
+
+    :param fname: File written by `compute_shard()`.
+    :type fname: str
+    :return: (meta, B), the description of the shard and its brightness.
+    :rtype: tuple
+    """
+    with _np.load(fname) as data:
+        return json.loads(str(data['meta'])), data['B']
+
+
+def merge_shards(fnames, check_only=False):
+    """Assembles the brightness of a sequence from its shards and computes
+    noise level and luminance.
+
+    :param fnames: Shard files.
+    :type fnames: list
+    :param check_only: Only check the shards, and return their description.
+    :type check_only: bool
+    :return: Dict of arrays as computed for a job by `campaign.process_job()`
+     ('B', 'B0', 'sB0', 'L', 'sL', 'regions', 'fov' and 'ref'). With
+     `check_only` the meta data of the first shard, without frame range.
+    :rtype: dict
+    :raises ValueError: if the shards belong to different jobs or image
+     files, overlap, or leave frames out.
+    """
+    shards = []
+    for f in fnames:
+        meta, bright = read_shard(f)
+        if len(bright) != meta['end'] - meta['start']:
+            raise ValueError("Shard %s has %d frames instead of %d."
+                             % (f, len(bright), meta['end'] - meta['start']))
+        shards.append((meta['start'], meta['end'], f, meta, bright))
+    if not shards:
+        raise ValueError("No shards to merge.")
+    shards.sort(key=lambda s: s[:2])
+    first = shards[0]
+    for _, _, f, meta, _ in shards[1:]:
+        for k in _checked:
+            if meta[k] != first[3][k]:
+                raise ValueError("Shards %s and %s differ in '%s'."
+                                 % (first[2], f, k))
+    pos, prev, gaps = 0, None, []
+    for start, end, f, _, _ in shards:
+        if start < pos:
+            raise ValueError("Shards %s and %s overlap in frames %d to %d."
+                             % (prev, f, start, min(pos, end)))
+        if start > pos:
+            gaps.append((pos, start))
+        pos, prev = end, f
+    frames = first[3]['frames']
+    if pos < frames:
+        gaps.append((pos, frames))
+    if gaps:
+        raise ValueError("Frames not covered by any shard: %s."
+                         % ", ".join("%d to %d" % g for g in gaps))
+    meta = {k: first[3][k] for k in _checked}
+    if check_only:
+        return meta
+    bright = _np.concatenate([s[4] for s in shards])
+    pipe, extra = _campaign.job_pipeline(meta['job'], tuple(meta['shape']))
+    ret = pipe.evaluate(bright)
+    ret.update(extra)
+    return ret
+
+
+def _find_job(config, name):
+    for job in _campaign.expand_jobs(config):
+        if _campaign.job_name(job) == name:
+            return job
+    raise ValueError("There is no job '%s' in the campaign." % name)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='python -m lib.shard',
+        description="Compute the brightness of a part of a sequence, or "
+                    "merge such parts.")
+    sub = parser.add_subparsers(dest='command')
+    comp = sub.add_parser('compute', help="compute one shard of a job")
+    comp.add_argument('config', help="campaign configuration (JSON)")
+    comp.add_argument('job', help="job name, e.g. pr06_casio-f1")
+    rng = comp.add_mutually_exclusive_group(required=True)
+    rng.add_argument('--frames', type=int, nargs=2, metavar=('START', 'END'),
+                     help="frame range (end exclusive)")
+    rng.add_argument('--shard', type=int, nargs=2,
+                     metavar=('INDEX', 'COUNT'),
+                     help="shard INDEX of COUNT equal shards")
+    comp.add_argument('--output', help="shard file (default: "
+                                       "<output>/<job>.shard-<start>-<end>"
+                                       ".npz)")
+    comp.add_argument('--processes', type=int,
+                      help="number of worker processes")
+    merge = sub.add_parser('merge', help="merge the shards of a job")
+    merge.add_argument('output', help="result file (.npz)")
+    merge.add_argument('shards', nargs='+', help="shard files")
+    merge.add_argument('--check', action='store_true',
+                       help="only check coverage of the shards")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+    try:
+        if args.command == 'compute':
+            config = _campaign.load_config(args.config)
+            job = _find_job(config, args.job)
+            start, end = args.frames if args.frames else (0, None)
+            cache = _cache.BrightnessCache(config['cache']) \
+                if config.get('cache') else None
+            fname = compute_shard(
+                job, start, end, shards=args.shard, fname=args.output,
+                directory=config.get('output', 'results'),
+                processes=args.processes or config.get('processes',
+                                                       _lum._nprocs),
+                video=config.get('video', False), cache=cache,
+                checkpoint=config.get('checkpoint'))
+            print("wrote %s" % fname)
+        else:
+            res = merge_shards(args.shards, check_only=args.check)
+            if args.check:
+                print("%d shards cover all %d frames"
+                      % (len(args.shards), res['frames']))
+            else:
+                _np.savez(args.output, **res)
+                print("wrote %s (%d frames from %d shards)"
+                      % (args.output, len(res['B']), len(args.shards)))
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())